@@ -1,6 +1,6 @@
 description = """a module that houses commands that can be sent or received and interpreted within lvalertMP. Also contains the definitions of QueueItems and Tasks needed to respond to commands. 
 NOTE: 
-this module relies *heavily* on inheritance and standardized naming convetions. The Command, CommandQueueItem, and CommandTask must all have identical name attributes. Then, all that remains is to define the actual execution of the task (via a method retrieved via getattr(task, task.name)) for each Task. This means that to define a new command, we have to define 3 new classes but really only one new method. 
+this module relies *heavily* on inheritance and standardized naming convetions. The Command, CommandQueueItem, and CommandTask must all have identical name attributes. Then, all that remains is to define the actual execution of the task (via a method retrieved via getattr(task, task.name)) for each Task. This means that to define a new command, we have to define 3 new classes but really only one new method. The 3 classes are then made known to lvalertMP via register (other libraries can do this too). 
 The only bit that requires some care is when we first instantiate the Commands (from within lvalert_commandMP), we must ensure that they have everything that is needed by the associated CommandTask for exectuion stored under their 'object' attribute. WE SHOULD THINK ABOUT GOOD WAYS TO ENSURE THIS IS THE CASE.
 """
 author = "reed.essick@ligo.org"
@@ -11,15 +11,10 @@ import sys
 import time
 
 import lvalertMPutils as utils
-
-from numpy import infty
+from lvalertMPutils import infty
 
 import json 
 
-import types ### needed to build dictionary to reference commands by name
-
-import logging
-
 #-------------------------------------------------
 # Define QueueItems and tasks
 #-------------------------------------------------
@@ -32,6 +27,7 @@ class CommandQueueItem(utils.QueueItem):
     '''
     name = 'command'
     description = 'parent of all command queue items. Implements automatic generation of associated Tasks, etc'
+    priority = 0 ### commands take the fast lane so operators are not stuck behind bulk follow-up work
 
     def __init__(self, t0, queue, queueByGraceID, logTag='iQ', **kwargs):
         tasks = []
@@ -50,6 +46,7 @@ class CommandTask(utils.Task):
     '''
     name = 'command'
     description = "parent of all command tasks"
+    priority = 0 ### commands take the fast lane so operators are not stuck behind bulk follow-up work
 
     required_kwargs  = []
     forbidden_kwargs = []
@@ -225,18 +222,18 @@ class CheckpointQueueTask(CommandTask):
         '''
         writes a representation of queue into 'filename' (required kwarg)
 
+        see lvalertMPutils.dumpQueue for the format, which loadQueue restores quickly
+
         WARNING: we may want to gzip or somehow compress the pickle files produced. We'd need to mirror this within loadQueue.
         '''
-        import pickle
         filename = self.kwargs['filename']
-        file_obj = open(filename, 'w')
-        pickle.dump( self.queue, file_obj ) 
-        pickle.dump( self.queueByGraceID, file_obj )
+        file_obj = open(filename, 'wb')
+        utils.dumpQueue( self.queue, self.queueByGraceID, file_obj )
         file_obj.close()
 
-        self.setExpiration(time.time()) ### update expiration -> self.expiration+self.timeout
+        self.setExpiration(utils.monotonic()) ### update expiration -> self.expiration+self.timeout
         ### if sleep was not proficed, this takes expiration=-np.infty -> -np.infty and the item will still end up being marked complete
-        ### we use time.time() instead of self.expiration to ensure that this is not marked complete accidentally if the queue has fallen behind
+        ### we use the current time instead of self.expiration to ensure that this is not marked complete accidentally if the queue has fallen behind
 
 #------------------------
 
@@ -261,27 +258,35 @@ class LoadQueueTask(CommandTask):
         '''
         loads a representation of queue from 'filename' (required kwarg)
 
-        WARNING: currently, this does not empty the queue first and only adds items from filename into existing SortedQueues
+        by default, the items from filename are merged into the existing SortedQueues.
+        If 'replace' is supplied (and true), everything already in queue and queueByGraceID is discarded first.
+        Either way, we keep the same queue and queueByGraceID objects, so anything that refers to them (eg: interactiveQueue) is unaffected
+        merging is linear in the size of the queues (see lvalertMPutils.SortedQueue.merge)
+        older checkpoints (pickled queues) can still be loaded (see lvalertMPutils.loadQueue)
         '''
-        ### load queue from pickle file
-        import pickle
         filename = self.kwargs['filename']
-        file_obj = open(filename, 'r')
-        queue = pickle.load(file_obj)
-        queueByGraceID = pickle.load(file_obj)
-        file_obj.close()
+        file_obj = open(filename, 'rb')
+        with utils.PauseGC(): ### the collector would otherwise repeatedly scan every item we just loaded while we merge
+            queue, queueByGraceID = utils.loadQueue( self.queue, self.queueByGraceID, file_obj ) ### commands are pointed at our queues
+            file_obj.close()
 
-        ### iterate through queue and add it into self.queue and self.queueByGraceID
-        for item in queue:
-            self.queue.insert( item )
+            replace = self.kwargs.get('replace', False)
 
-        for graceid, queue in queueByGraceID.items():
-            if self.queueByGraceID.has_key(graceid): ### SortedQueue already exists, so insert into it
-                for item in queue:
-                    self.queueByGraceID[graceid].insert( item )
+            ### merge queue into self.queue and queueByGraceID into self.queueByGraceID
+            self.queue.merge( queue, replace=replace )
 
-            else: ### no SortedQueue exists, so just use this one
-                self.queueByGraceID[graceid] = queue
+            if replace:
+                self.queueByGraceID.clear()
+            for graceid, q in queueByGraceID.items():
+                if self.queueByGraceID.has_key(graceid): ### SortedQueue already exists, so merge into it
+                    self.queueByGraceID[graceid].merge( q )
+
+                else: ### no SortedQueue exists, so just use this one
+                    self.queueByGraceID[graceid] = q
+
+        if verbose:
+            logger = self.getLogger() ### want this to redirect to interactiveQueue's logger
+            logger.info( '%s %d items from %s', 'replaced queue with' if replace else 'merged', len(queue), filename )
 
 #------------------------
 
@@ -309,10 +314,11 @@ class PrintMessageTask(CommandTask):
         note, verbose will make this print to STDOUT via logging.StreamHandler
         '''
         ### print set up logger
-        logger  = logging.getLogger('%s.%s'%(self.logTag, self.name)) ### want this to also propagate to interactiveQueue's logger
+        logger  = self.getLogger() ### want this to also propagate to interactiveQueue's logger
         if verbose:
-            logger.addHandler( logging.StreamHandler() ) ### we don't format this so that it prints exactly as supplied
-                                                         ### however, interactiveQueue's handler *will* be formatted nicely 
+            utils.addHandler( logger, utils.getStreamHandler() ) ### we don't format this so that it prints exactly as supplied
+                                                                 ### however, interactiveQueue's handler *will* be formatted nicely 
+                                                                 ### the handler is cached and only added once, so repeated calls do not duplicate output
 
         ### print to logger
         logger.info( self.kwargs['message'] )
@@ -341,8 +347,8 @@ class SendEmailTask(CommandTask):
         sends email via delegation to lvalertMPutils.sendEmail
         '''
         if verbose:
-            logger = logging.getLogger('%s.%s'%(self.logTag,self.name)) ### want this to redirect to interactiveQueue's logger
-            logger.info( 'sending email to %s'%self.kwargs['recipients'] )
+            logger = self.getLogger() ### want this to redirect to interactiveQueue's logger
+            logger.info( 'sending email to %s', self.kwargs['recipients'] )
 
         utils.sendEmail( self.kwargs['recipients'].split(), self.kwargs['body'], self.kwargs['subject'] )
 
@@ -370,11 +376,14 @@ class PrintQueueTask(CommandTask):
         prints queue and queueByGraceID to a file
         will overwrite anything existing in that path
 
+        if 'limit' or 'graceid' are supplied, we only print items from queueByGraceID[graceid] (or queue if graceid is not supplied), one per line.
+        At most 'limit' items are printed, starting with the item at 'offset' (DEFAULT=0)
+
         NOTE: if filename=="STDOUT", we default to stdout. if it's "STDERR", we use stderr
         '''
         if verbose: ### print set up logger
-            logger = logging.getLogger('%s.%s'%(self.logTag,self.name)) ### want this to redirect to interactiveQueue's logger
-            logger.info( 'printing Queue to %s'%self.kwargs['filename'] )
+            logger = self.getLogger() ### want this to redirect to interactiveQueue's logger
+            logger.info( 'printing Queue to %s', self.kwargs['filename'] )
 
         filename = self.kwargs['filename']
         useSTDOUT = filename=='STDOUT'
@@ -386,13 +395,294 @@ class PrintQueueTask(CommandTask):
         else:
             file_obj = open(filename, 'w')
 
-        print >> file_obj, self.queue
-        for graceid, q in self.queueByGraceID.items():
-            print >> file_obj, "%s : %s"%(graceid, q)
+        if self.kwargs.has_key('limit') or self.kwargs.has_key('graceid'): ### paginated print, one item per line
+            graceid = self.kwargs.get('graceid', None)
+            if graceid==None:
+                queue = self.queue
+            else:
+                queue = self.queueByGraceID.get(graceid, [])
+
+            offset = int(self.kwargs.get('offset', 0))
+            limit = self.kwargs.get('limit', None)
+            if limit!=None:
+                limit = offset+int(limit)
+
+            print >> file_obj, "%s : %d items, showing [%d:%s]"%(graceid if graceid!=None else 'queue', len(queue), offset, limit if limit!=None else '')
+            for ind in xrange(offset, min(len(queue), limit) if limit!=None else len(queue)):
+                print >> file_obj, "    %d : %s"%(ind, queue[ind])
+
+        else: ### print everything
+            print >> file_obj, self.queue
+            for graceid, q in self.queueByGraceID.items():
+                print >> file_obj, "%s : %s"%(graceid, q)
 
         if not (useSTDOUT or useSTDERR):
             file_obj.close()
 
+#------------------------
+
+class ExportQueueItem(CommandQueueItem):
+    '''
+    QueueItem that writes queue as json lines to a file or a unix socket
+    '''
+    name = 'exportQueue'
+    description = 'writes queue as json lines, one per item, to a file (overwriting anything that exists in that path) or a unix socket'
+
+class ExportQueueTask(CommandTask):
+    '''
+    Task that writes queue as json lines to a file or a unix socket
+    '''
+    name = 'exportQueue'
+    description = 'writes queue as json lines, one per item, to a file (overwriting anything that exists in that path) or a unix socket'
+
+    required_kwargs  = []
+    forbidden_kwargs = []
+
+    def exportQueue(self, verbose=False, **kwargs):
+        '''
+        writes one json object per item in queue (see lvalertMPutils.itemRecord) into either 'filename' or 'socket' (the path of a listening unix socket)
+        lines are written as we go, so we never build the whole export in memory.
+        Writes to a socket give up after 'timeout' sec (DEFAULT=10) without progress so a slow reader cannot stall the queue
+
+        if 'graceid' is supplied, we only export items from queueByGraceID[graceid]. At most 'limit' items are exported, starting with the item at 'offset' (DEFAULT=0)
+
+        NOTE: if filename=="STDOUT", we default to stdout. if it's "STDERR", we use stderr
+
+        returns the number of items exported
+        '''
+        filename = self.kwargs.get('filename', None)
+        path = self.kwargs.get('socket', None)
+        if (filename is None)==(path is None):
+            raise ValueError('please supply exactly one of : filename, socket')
+
+        graceid = self.kwargs.get('graceid', None)
+        if graceid==None:
+            queue = self.queue
+        else:
+            queue = self.queueByGraceID.get(graceid, [])
+
+        offset = int(self.kwargs.get('offset', 0))
+        limit = self.kwargs.get('limit', None)
+        end = len(queue) if limit==None else min(len(queue), offset+int(limit))
+        items = (queue[ind] for ind in xrange(offset, end))
+
+        if path is not None:
+            import socket
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout( float(self.kwargs.get('timeout', 10)) )
+            try:
+                sock.connect( path )
+                file_obj = sock.makefile('w')
+                try:
+                    n = utils.exportItems( items, file_obj )
+                finally:
+                    file_obj.close()
+            finally:
+                sock.close()
+
+        elif filename=='STDOUT':
+            n = utils.exportItems( items, sys.stdout )
+        elif filename=='STDERR':
+            n = utils.exportItems( items, sys.stderr )
+        else:
+            file_obj = open(filename, 'w')
+            try:
+                n = utils.exportItems( items, file_obj )
+            finally:
+                file_obj.close()
+
+        if verbose:
+            logger = self.getLogger() ### want this to redirect to interactiveQueue's logger
+            logger.info( 'exported %d items to %s', n, path if path is not None else filename )
+
+        return n
+
+#------------------------
+
+class QueueStatsItem(CommandQueueItem):
+    '''
+    QueueItem that reports aggregate statistics about queue and queueByGraceID
+    '''
+    name = 'queueStats'
+    description = 'reports counts by item name, by GraceID, and by expiration'
+
+class QueueStatsTask(CommandTask):
+    '''
+    Task that reports aggregate statistics about queue and queueByGraceID
+    '''
+    name = 'queueStats'
+    description = 'reports counts by item name, by GraceID, and by expiration'
+
+    required_kwargs  = []
+    forbidden_kwargs = []
+
+    buckets = [('expired', 0), ('1min', 60), ('10min', 600), ('1hr', 3600), ('1day', 86400)] ### upper edges (relative to now) of expiration buckets
+
+    def queueStats(self, verbose=False, **kwargs):
+        '''
+        counts items in queue by name and by priority (cached within SortedQueue), items in queueByGraceID by GraceID, and items in queue by expiration relative to now
+        also reports how long the interactiveQueue that owns queue waits between epochs, if available
+        nothing here iterates over the items in the queue, so this is cheap even for large queues
+
+        if 'filename' is supplied, we write the statistics into that file as json (overwriting anything that exists in that path)
+
+        returns a dictionary
+        '''
+        now = utils.monotonic()
+
+        byExpiration = {}
+        N = 0
+        for label, dt in self.buckets:
+            n = self.queue.countExpired(now+dt)
+            byExpiration[label] = n-N
+            N = n
+        byExpiration['later'] = len(self.queue)-N
+
+        stats = {
+            'size'         : len(self.queue),
+            'complete'     : self.queue.complete,
+            'byName'       : dict(self.queue.counts),
+            'byPriority'   : dict(self.queue.lanes),
+            'byGraceID'    : dict((graceid, len(q)) for graceid, q in self.queueByGraceID.items()),
+            'byExpiration' : byExpiration,
+        }
+        if hasattr(self.queue, 'loopStats'): ### how long the interactiveQueue that owns queue waits between epochs
+            stats['loop'] = dict(self.queue.loopStats)
+
+        if verbose:
+            logger = self.getLogger() ### want this to redirect to interactiveQueue's logger
+            logger.info( 'queue size=%d, complete=%d, graceids=%d', stats['size'], stats['complete'], len(stats['byGraceID']) )
+
+        if self.kwargs.has_key('filename'):
+            file_obj = open(self.kwargs['filename'], 'w')
+            json.dump( stats, file_obj )
+            file_obj.close()
+
+        return stats
+
+#------------------------
+
+def getParams(queue):
+    '''
+    returns the parameters of the interactiveQueue that owns queue (see lvalertMPutils.paramNames)
+    raises a RuntimeError if queue is not owned by an interactiveQueue
+    '''
+    if not hasattr(queue, 'params'):
+        raise RuntimeError('queue does not belong to a running interactiveQueue, so there are no parameters to access')
+    return queue.params
+
+class SetParamsItem(CommandQueueItem):
+    '''
+    QueueItem that changes the parameters of the running interactiveQueue
+    '''
+    name = 'setParams'
+    description = 'changes sleep, maxComplete, maxFrac, warnThr, recipients, warnDelay, or maxWarn in the running interactiveQueue'
+
+class SetParamsTask(CommandTask):
+    '''
+    Task that changes the parameters of the running interactiveQueue
+    '''
+    name = 'setParams'
+    description = 'changes sleep, maxComplete, maxFrac, warnThr, recipients, warnDelay, or maxWarn in the running interactiveQueue'
+
+    required_kwargs  = []
+    forbidden_kwargs = []
+
+    def __init__(self, queue, queueByGraceID, logTag='iQ', **kwargs):
+        super(SetParamsTask, self).__init__(queue, queueByGraceID, logTag=logTag, **kwargs)
+        self.timeout = -infty ### sleep is a parameter we set, not our delay, so we always execute ASAP
+
+    def setParams(self, verbose=False, **kwargs):
+        '''
+        updates any of lvalertMPutils.paramNames supplied as kwargs. Everything else is ignored.
+        values are validated via lvalertMPutils.checkParam and nothing is changed if any of them are not allowed
+
+        NOTE: unlike every other command, sleep is not the delay before this task is executed. We always execute ASAP
+
+        returns a dictionary with the parameters that changed (name -> [old, new]) and the current parameters
+        '''
+        params = getParams(self.queue)
+        new = dict((name, self.kwargs[name]) for name in utils.paramNames if self.kwargs.has_key(name))
+        if not new:
+            raise ValueError('please supply at least one of : %s'%(", ".join(utils.paramNames)))
+
+        changes = utils.updateParams( params, new )
+
+        if verbose:
+            logger = self.getLogger() ### want this to redirect to interactiveQueue's logger
+            for name in sorted(changes.keys()):
+                logger.info( 'setParams %s : %s -> %s', name, changes[name][0], changes[name][1] )
+
+        return {'changed':changes, 'params':dict(params)}
+
+class GetParamsItem(CommandQueueItem):
+    '''
+    QueueItem that reports the parameters of the running interactiveQueue
+    '''
+    name = 'getParams'
+    description = 'reports sleep, maxComplete, maxFrac, warnThr, recipients, warnDelay, and maxWarn of the running interactiveQueue'
+
+class GetParamsTask(CommandTask):
+    '''
+    Task that reports the parameters of the running interactiveQueue
+    '''
+    name = 'getParams'
+    description = 'reports sleep, maxComplete, maxFrac, warnThr, recipients, warnDelay, and maxWarn of the running interactiveQueue'
+
+    required_kwargs  = []
+    forbidden_kwargs = []
+
+    def getParams(self, verbose=False, **kwargs):
+        '''
+        returns a dictionary of the current parameters
+        '''
+        params = dict(getParams(self.queue))
+
+        if verbose:
+            logger = self.getLogger() ### want this to redirect to interactiveQueue's logger
+            logger.info( 'getParams : %s', ", ".join("%s=%s"%(name, params[name]) for name in utils.paramNames if params.has_key(name)) )
+
+        return params
+
+#------------------------
+
+class DeadLettersItem(CommandQueueItem):
+    '''
+    QueueItem that reports the QueueItems that failed within the running interactiveQueue
+    '''
+    name = 'deadLetters'
+    description = 'reports the QueueItems that failed within the running interactiveQueue. Forgets them if "clear" is supplied'
+
+class DeadLettersTask(CommandTask):
+    '''
+    Task that reports the QueueItems that failed within the running interactiveQueue
+    '''
+    name = 'deadLetters'
+    description = 'reports the QueueItems that failed within the running interactiveQueue. Forgets them if "clear" is supplied'
+
+    required_kwargs  = []
+    forbidden_kwargs = []
+
+    def deadLetters(self, verbose=False, **kwargs):
+        '''
+        returns a list of records (see lvalertMPutils.deadLetter), oldest first
+        if 'clear' is supplied (and true), we forget these records after reporting them
+        raises a RuntimeError if queue is not owned by an interactiveQueue
+        '''
+        if not hasattr(self.queue, 'deadLetters'):
+            raise RuntimeError('queue does not belong to a running interactiveQueue, so there are no dead letters to access')
+        letters = list(self.queue.deadLetters)
+
+        if verbose:
+            logger = self.getLogger() ### want this to redirect to interactiveQueue's logger
+            for letter in letters:
+                logger.info( 'deadLetter %s : %s (graceid=%s) failed at %s with remaining tasks=[%s]', letter['name'], letter['description'], letter['graceid'], time.ctime(letter['time']), ", ".join(letter['tasks']) )
+
+        if self.kwargs.get('clear', False):
+            self.queue.deadLetters.clear()
+
+        return letters
+
 #-------------------------------------------------
 # define representations of commands
 #-------------------------------------------------
@@ -542,27 +832,98 @@ class PrintQueue(Command):
     '''
     name = 'printQueue'
 
+#------------------------
+
+class ExportQueue(Command):
+    '''
+    write queue as json lines to a file or a unix socket
+    '''
+    name = 'exportQueue'
+
+    def checkObject(self):
+        '''
+        in addition to Command.checkObject, requires exactly one of filename and socket
+        so a bad Command is rejected when it is built instead of when it is executed
+        '''
+        super(ExportQueue, self).checkObject()
+        kwargs = self.data['object']
+        if kwargs.has_key('filename')==kwargs.has_key('socket'):
+            raise KeyError('Command=%s requires exactly one of kwargs=filename, socket'%self.name)
+
+#------------------------
+
+class QueueStats(Command):
+    '''
+    report counts by item name, by GraceID, and by expiration
+    '''
+    name = 'queueStats'
+
+#------------------------
+
+class SetParams(Command):
+    '''
+    change the parameters of the running interactiveQueue
+    '''
+    name = 'setParams'
+
+#------------------------
+
+class GetParams(Command):
+    '''
+    report the parameters of the running interactiveQueue
+    '''
+    name = 'getParams'
+
+#------------------------
+
+class DeadLetters(Command):
+    '''
+    report (and optionally forget) the QueueItems that failed within the running interactiveQueue
+    '''
+    name = 'deadLetters'
+
 #-------------------------------------------------
 # define useful variables
 #-------------------------------------------------
 
 ### set up dictionaries
+### these are populated via register so that other libraries can add their own commands without modifying this module
 __cid__ = {} ### Commands by their name attributes
 __qid__ = {} ### QueueItems by their name attributes
 __tid__ = {} ### Tasks by their name attributes
-for x in vars().values():
-
-    if isinstance(x, type):
-        if issubclass(x, Command):
-            __cid__[x.name] = x
-        elif issubclass(x, CommandQueueItem):
-            __qid__[x.name] = x
-        elif issubclass(x, CommandTask):
-            __tid__[x.name] = x
 
-### confirm that __cid__, __qid__, and __tid__ all have matching keys
-assert (sorted(__cid__.keys()) == sorted(__qid__.keys())) and (sorted(__cid__.keys()) == sorted(__tid__.keys())), \
-    "inconsistent name attributes within sets of defined Commands, CommandQueueItems, and CommandTasks\n__cid__:%s\n__qid__:%s\n__tid__:%s"%(sorted(__cid__.keys()), sorted(__qid__.keys()), sorted(__tid__.keys()))
+def register( command, queueItem, task ):
+    '''
+    registers a Command along with the CommandQueueItem and CommandTask that implement it
+    all three must have identical name attributes, otherwise we raise a ValueError
+    registering a name a second time replaces the previous classes
+    '''
+    if not (issubclass(command, Command) and issubclass(queueItem, CommandQueueItem) and issubclass(task, CommandTask)):
+        raise TypeError('must register a Command, a CommandQueueItem, and a CommandTask')
+    if not (command.name == queueItem.name == task.name):
+        raise ValueError("inconsistent name attributes : Command=%s, CommandQueueItem=%s, CommandTask=%s"%(command.name, queueItem.name, task.name))
+    __cid__[command.name] = command
+    __qid__[queueItem.name] = queueItem
+    __tid__[task.name] = task
+
+for command, queueItem, task in [
+        (Command,         CommandQueueItem,      CommandTask),
+        (RaiseException,  RaiseExceptionItem,    RaiseExceptionTask),
+        (RaiseWarning,    RaiseWarningItem,      RaiseWarningTask),
+        (ClearQueue,      ClearQueueItem,        ClearQueueTask),
+        (ClearGraceID,    ClearGraceIDQueueItem, ClearGraceIDTask),
+        (CheckpointQueue, CheckpointQueueItem,   CheckpointQueueTask),
+        (LoadQueue,       LoadQueueItem,         LoadQueueTask),
+        (PrintMessage,    PrintMessageItem,      PrintMessageTask),
+        (SendEmail,       SendEmailItem,         SendEmailTask),
+        (PrintQueue,      PrintQueueItem,        PrintQueueTask),
+        (ExportQueue,     ExportQueueItem,       ExportQueueTask),
+        (QueueStats,      QueueStatsItem,        QueueStatsTask),
+        (SetParams,       SetParamsItem,         SetParamsTask),
+        (GetParams,       GetParamsItem,         GetParamsTask),
+        (DeadLetters,     DeadLettersItem,       DeadLettersTask),
+    ]:
+    register( command, queueItem, task )
 
 #------------------------
 # utilities for looking up info within private variables
@@ -578,6 +939,20 @@ def initCommand( name, **kwargs ):
 
 #-----------
 
+def writeBatch( cmds ):
+    '''
+    combines several Command objects into a single json string that can be sent as one alert
+    each Command is validated (via checkObject) before it is included
+    parseCommand expands this back into the corresponding QueueItems
+    '''
+    batch = []
+    for cmd in cmds:
+        cmd.checkObject() ### ensure we have all the kwargs we need
+        batch.append( {'alert_type':cmd.data['alert_type'], 'object':cmd.data['object']} )
+    return json.dumps( {'uid':'command', 'alert_type':'batch', 'object':{'commands':batch}} )
+
+#-----------
+
 def knownCommands():
     '''
     returns a sorted list of known commands
@@ -613,21 +988,49 @@ def parseCommand( queue, queueByGraceID, alert, t0, logTag='iQ' ):
     a doppelganger for parseAlert that focuses on commands.
     this should be called from within parseAlert as needed
     '''
+    insertItems( queue, queueByGraceID, genQueueItems(queue, queueByGraceID, alert, t0, logTag=logTag), logTag=logTag ) ### add items to the queue
+
+    return 0 ### the number of new completed tasks in queue. 
+             ### This is not strictly needed and is not captured and we should modify the attribute of SortedQueue directly
+
+def genQueueItems( queue, queueByGraceID, alert, t0, logTag='iQ' ):
+    '''
+    instantiates the Command(s) described by alert and returns the list of QueueItems they generate
+    alerts with alert_type="batch" (see writeBatch) are expanded into the QueueItems for every Command they contain
+    all Commands are validated before any QueueItems are returned, so a bad batch does not partially modify the queue
+    '''
     if alert['uid'] != 'command':
         raise ValueError('I only know how to parse alerts with uid="command"')
 
+    if alert['alert_type']=='batch':
+        cmds = [initCommand( cmd['alert_type'], **cmd['object'] ) for cmd in alert['object']['commands']]
+    else:
+        cmds = [initCommand( alert['alert_type'], **alert['object'] )] ### instantiate the Command object
+
+    items = []
+    for cmd in cmds:
+        items += cmd.genQueueItems(queue, queueByGraceID, t0, logTag=logTag)
+    return items
+
+def insertItems( queue, queueByGraceID, items, logTag='iQ' ):
+    '''
+    inserts QueueItems generated from Commands into queue and, if they have a graceid attribute, into queueByGraceID
+    '''
     ### set up logger
-    logger = logging.getLogger('%s.parseCommand'%logTag) ### want this to propagate to interactiveQueue's logger
+    logger = utils.getLogger(logTag, 'parseCommand') ### want this to propagate to interactiveQueue's logger
 
-    cmd = initCommand( alert['alert_type'], **alert['object'] ) ### instantiate the Command object
+    if len(items)==1: ### a single binary search is cheaper than merging
+        queue.insert( items[0] )
+    else: ### one pass over queue for the whole batch
+        queue.merge( items )
 
-    for item in cmd.genQueueItems(queue, queueByGraceID, t0, logTag=logTag): ### add items to the queue
-        queue.insert( item )
+    byGraceID = {} ### graceid -> the items to merge into queueByGraceID[graceid]
+    for item in items:
         if hasattr(item, 'graceid'):
-            if not queueByGraceID.has_key(item.graceid):
-                queueByGraceID[item.graceid] = utils.SortedQueue()
-            queueByGraceID[item.graceid].insert( item )
-        logger.debug( 'added Command=%s'%item.name )
+            byGraceID.setdefault(item.graceid, []).append( item )
+        logger.debug( 'added Command=%s', item.name )
 
-    return 0 ### the number of new completed tasks in queue. 
-             ### This is not strictly needed and is not captured and we should modify the attribute of SortedQueue directly
+    for graceid, batch in byGraceID.items():
+        if not queueByGraceID.has_key(graceid):
+            queueByGraceID[graceid] = utils.SortedQueue()
+        queueByGraceID[graceid].merge( batch )
@@ -7,19 +7,26 @@ import os
 
 import time
 import json
+import random
 
 import socket ### used to determine hostname for email warnings
 import getpass ### used to determine username for email warnings
 
-from numpy import infty
-
 import ConfigParser
 
 import lvalertMPutils as utils
+from lvalertMPutils import infty
+import commands
 
 import logging
 import traceback
 
+import multiprocessing
+import collections
+import signal
+
+import importlib
+
 #---------------------------------------------------------------------------------------------------
 
 ### set up email warning templates
@@ -86,7 +93,299 @@ interactiveQueue contains SortedQueue with fewer than %d elements (len(queue)=%d
 """
 #---------------------------------------------------------------------------------------------------
 
-def interactiveQueue(connection, config_filename, verbose=True, sleep=0.1, maxComplete=100, maxFrac=0.5, warnThr=1e3, recipients=[], warnDelay=3600, maxWarn=24, print2stdout=False):
+### registry of parseAlert implementations by process_type
+### values are either "module:attribute" strings, which are imported on demand, or the parseAlert functions themselves
+### external libraries can add process_types without editing this module through the "lvalertMP.process_types" entry point group
+###     entry_points={'lvalertMP.process_types' : ['my_type = my_library.my_module:parseAlert']}
+
+__pkg__ = __name__.rpartition('.')[0] ### the package containing this module, so "test" refers to the same parseAlert module however we were imported
+
+__process_types__ = {
+    'test'                 : ('%s.parseAlert'%__pkg__ if __pkg__ else 'parseAlert')+':parseAlert',
+    'event_supervisor'     : 'eventSupervisor.eventSupervisor:parseAlert',
+    'approval_processorMP' : 'approval_processorMP.approval_processorMPutils:parseAlert',
+}
+
+__entry_point_group__ = 'lvalertMP.process_types'
+
+def registerProcessType( process_type, parseAlert ):
+    """
+    associates process_type with parseAlert, which is either a "module:attribute" string or a callable
+    overrides any previous registration
+    """
+    if not (isinstance(parseAlert, str) or callable(parseAlert)):
+        raise TypeError('parseAlert must be a "module:attribute" string or callable')
+    __process_types__[process_type] = parseAlert
+
+def loadEntryPoints():
+    """
+    registers every process_type advertised through the "lvalertMP.process_types" entry point group
+    entry points are loaded lazily, so this does not import anything but pkg_resources
+    does nothing if pkg_resources is not available
+    """
+    try:
+        import pkg_resources
+    except ImportError:
+        return
+    for entry_point in pkg_resources.iter_entry_points(__entry_point_group__):
+        registerProcessType( entry_point.name, '%s:%s'%(entry_point.module_name, '.'.join(entry_point.attrs)) )
+
+def knownProcessTypes():
+    """
+    returns a list of the registered process_types
+    """
+    return sorted(__process_types__.keys())
+
+def getParseAlert( process_type ):
+    """
+    returns the parseAlert function for process_type, importing it if needed
+    process_type may also be a "module:attribute" string, in which case it does not need to be registered
+
+    the function is cached in the registry, so calling this in lvalert_listenMP before forking means children share
+    the already-imported modules instead of importing them again
+    """
+    if not __process_types__.has_key(process_type):
+        if ':' not in process_type:
+            loadEntryPoints() ### maybe this was registered by another library
+        if not __process_types__.has_key(process_type):
+            if ':' not in process_type:
+                raise ValueError("process_type=%s not understood. Known process_types are : %s"%(process_type, ", ".join(knownProcessTypes())))
+            registerProcessType( process_type, process_type )
+
+    parseAlert = __process_types__[process_type]
+    if isinstance(parseAlert, str): ### import the function and cache it
+        module, attr = parseAlert.split(':')
+        parseAlert = importlib.import_module(module)
+        for name in attr.split('.'):
+            parseAlert = getattr(parseAlert, name)
+        __process_types__[process_type] = parseAlert
+
+    return parseAlert
+
+def preload( config, sections=None ):
+    """
+    imports the parseAlert functions needed by the children described in lvalert_listenMP's config file
+    meant to be called before forking so that children share the imported modules copy-on-write
+    if sections is None, we preload for every section
+
+    returns a list of the process_types that were loaded
+    """
+    process_types = []
+    for section in (config.sections() if sections is None else sections):
+        childConfig = ConfigParser.SafeConfigParser()
+        childConfig.read( config.get(section, "childConfig") )
+        process_type = childConfig.get('general', 'process_type')
+        getParseAlert( process_type )
+        if process_type not in process_types:
+            process_types.append( process_type )
+    return process_types
+
+#---------------------------------------------------------------------------------------------------
+
+def fork( foo, args ):
+    """
+    forks foo via multiprocessing and connects it to the parent with a Pipe
+    used by lvalert_listenMP (and lvalert_replayMP) to launch interactiveQueue
+
+    foo must accept a multiprocessing.connection instance as its first argument
+
+    returns proc, conn where conn is the parent's end of the Pipe
+    """
+    conn1, conn2 = multiprocessing.Pipe()
+    args = [conn2]+list(args) ### connection must be the first argument!
+
+    proc = multiprocessing.Process(target=foo, args=args ) ### define the function based on the config file?
+    proc.start()
+    conn2.close() ### only the child should be able to communicate through conn2, so we close it here
+
+    return proc, conn1
+
+def worker( connection ):
+    """
+    an idle process that waits for lvalert_listenMP to assign it a section of its config file
+    blocks until it receives
+        {'type':'attach', 'args':[...]}
+    and then calls interactiveQueue(connection, *args). Returns without doing anything if it receives
+        {'type':'exit'}
+    everything else is ignored
+    """
+    signal.signal(signal.SIGHUP, signal.SIG_IGN) ### lvalert_listenMP reloads its config on SIGHUP, which should not affect its children
+
+    while True:
+        msg = connection.recv()
+        if isinstance(msg, dict):
+            if msg.get('type')=='attach':
+                return interactiveQueue( connection, *msg['args'] )
+            elif msg.get('type')=='exit':
+                return
+
+class Pool(object):
+    """
+    a pool of prewarmed idle workers, forked from the parent after it has imported everything its children need (see preload)
+    attaching a section to a worker only costs a message through the Pipe, so adding or replacing a child is much faster than
+    starting a new process from scratch
+
+    NOTE: this plays the role of a forkserver, which is not available in python2's multiprocessing
+    """
+
+    def __init__(self, size=1):
+        self.size = size
+        self.idle = [] ### (proc, conn) for each idle worker
+
+    def start(self):
+        """
+        forks idle workers until there are self.size of them
+        """
+        self.idle = [(proc, conn) for proc, conn in self.idle if proc.is_alive()]
+        while len(self.idle) < self.size:
+            self.idle.append( fork( worker, [] ) )
+
+    def attach(self, args):
+        """
+        hands args (the arguments for interactiveQueue, excluding the connection) to an idle worker and refills the pool
+        forks a new worker if none are idle
+
+        returns proc, conn where conn is the parent's end of the Pipe
+        """
+        while self.idle:
+            proc, conn = self.idle.pop(0)
+            if proc.is_alive():
+                break
+        else:
+            proc, conn = fork( worker, [] )
+        conn.send( {'type':'attach', 'args':list(args)} )
+
+        self.start() ### replace the worker we just used
+        return proc, conn
+
+    def close(self):
+        """
+        tells all idle workers to exit and waits for them
+        """
+        for proc, conn in self.idle:
+            try:
+                conn.send( {'type':'exit'} )
+            except IOError: ### worker already exited
+                pass
+        for proc, conn in self.idle:
+            proc.join()
+        self.idle = []
+
+def childArgs( config, section ):
+    """
+    extracts the arguments for interactiveQueue from a section of lvalert_listenMP's config file
+    defaults match those used by lvalert_listenMP
+
+    returns a list of arguments in the order expected by interactiveQueue (excluding the connection)
+    """
+    childConfig = config.get(section, "childConfig")
+
+    if config.has_option(section, "verbose"):
+        verbose = config.getboolean(section, "verbose")
+    else:
+        verbose = False
+    if config.has_option(section, "print2stdout"):
+        print2stdout = config.getboolean(section, "print2stdout")
+    else:
+        print2stdout = False
+    if config.has_option(section, "sleep"):
+        sleep = config.getfloat(section, "sleep")
+    else:
+        sleep = 0.1
+
+    ### parameters about garbage collection
+    if config.has_option(section, "maxComplete"):
+        maxComplete = config.getint(section, "maxComplete")
+    else:
+        maxComplete = 100
+    if config.has_option(section, "maxFrac"):
+        maxFrac = config.getfloat(section, "maxFrac")
+    else:
+        maxFrac = 0.5
+
+    ### parameters about warnings
+    if config.has_option(section, "warnThr"):
+        warnThr = config.getfloat(section, "warnThr")
+    else:
+        warnThr = 1e3
+    if config.has_option(section, "recipients"):
+        recipients = config.get(section, "recipients").split()
+    else:
+        recipients = []
+    if config.has_option(section, "warnDelay"):
+        warnDelay = config.getfloat(section, "warnDelay")
+    else:
+        warnDelay = 3600
+    if config.has_option(section, "maxWarn"):
+        maxWarn = config.getint(section, "maxWarn")
+    else:
+        maxWarn = 24
+
+    return [childConfig, verbose, sleep, maxComplete, maxFrac, warnThr, recipients, warnDelay, maxWarn, print2stdout]
+
+def childParams( config, section ):
+    """
+    extracts the parameters of interactiveQueue that can be changed while it is running from a section of lvalert_listenMP's config file
+
+    returns a dictionary : name -> value (see lvalertMPutils.paramNames)
+    """
+    return dict(zip(utils.paramNames, childArgs(config, section)[2:9])) ### sleep through maxWarn
+
+def __terminate__(signum, frame):
+    """
+    SIGTERM handler for interactiveQueue. Unwinds the main loop (running its finally clause) instead of exiting immediately
+    """
+    raise SystemExit(0)
+
+def reply( connection, requests, item, results, error=None ):
+    """
+    records the results of executing item, which was generated by a request from lvalert_listenMP's control socket
+    once every QueueItem generated by that request has been executed, we send the reply through connection
+    """
+    rid = item.rid
+    del item.rid ### only reply once, even if this item repeats
+
+    msg = requests[rid]
+    msg['results'] += results
+    if error is not None:
+        msg['status'] = 'error'
+        msg['error'] = error if not msg.has_key('error') else msg['error']+'\n'+error
+    msg['remaining'] -= 1
+
+    if not msg['remaining']: ### everything has been executed
+        requests.pop(rid)
+        for key in ['remaining', 'items', 'deadline']: ### only used to track the request
+            msg.pop(key)
+        connection.send( msg )
+
+def sweepRequests( connection, requests, queue, now ):
+    """
+    replies for QueueItems generated by requests from lvalert_listenMP's control socket that will never be executed because they were
+    marked complete or removed from queue without executing (eg: by clearGraceID, clearQueue, loadQueue, shed or collapse)
+    and forgets requests whose deadline has passed, since lvalert_listenMP no longer waits for them
+    """
+    for rid, msg in requests.items():
+        if now > msg['deadline']: ### nobody is waiting for this anymore
+            for item in msg['items']:
+                if getattr(item, 'rid', None)==rid:
+                    del item.rid
+            requests.pop(rid)
+            continue
+
+        for item in msg['items']:
+            if getattr(item, 'rid', None)!=rid: ### already replied
+                continue
+            if not item.complete:
+                try:
+                    queue.find( item )
+                    continue ### still waiting to be executed
+                except ValueError:
+                    pass
+            reply(connection, requests, item, [None], error='QueueItem=%s was removed before it was executed'%item.name)
+
+#---------------------------------------------------------------------------------------------------
+
+def interactiveQueue(connection, config_filename, verbose=True, sleep=0.1, maxComplete=100, maxFrac=0.5, warnThr=1e3, recipients=[], warnDelay=3600, maxWarn=24, print2stdout=False, ack=False):
     """
     a simple function that manages a queue
 
@@ -99,10 +398,37 @@ def interactiveQueue(connection, config_filename, verbose=True, sleep=0.1, maxCo
     maxFrac    : the maximum fraction of len(queue) that is allowed to be complete before initiating cleanup
 
     warnThr    : the maximum length of queue before we start sending warning emails
+                 this is also the threshold for the overload policies (overload_policy in config_filename's [general] section)
+                   shed     : mark the least urgent items as complete until len(queue) <= warnThr
+                   delay    : hold new alerts (except commands and heartbeats) until len(queue) <= warnThr, keeping them in order
+                              at most delay_size alerts are held and delay_overflow ("oldest" or "newest") decides which one is dropped
+                   collapse : only keep the most recent item for each GraceID
+                   throttle : ask lvalert_listenMP to stop sending us alerts (except commands and heartbeats) for throttle_duration seconds
     recipients : list of email addresses that will receive a message if len(queue) > warningThr
     warnDelay  : the amount of time we wait before sending a repeat warning message
     maxWarn    : the maximum amount of warnings we send before silencing this functionality
+
+    ack        : if True, we send a dictionary back through connection after handling each alert
+                 {'type':'ack', 't0':t0, 'time':time.time()} where t0 is the wall-clock time we were sent with the alert
+                 used by lvalert_replayMP to measure latency and throughput
+
+    In addition to (alert, t0) tuples, connection may deliver requests from lvalert_listenMP's control socket
+        {'type':'request', 'rid':rid, 'payload':alert, 't0':t0, 'timeout':timeout}
+    which are answered with
+        {'type':'reply', 'rid':rid, 'status':'ok' or 'error', 'results':[...], 'error':traceback}
+    Commands are answered once their QueueItem is executed and the reply contains the results returned by their Tasks.
+    QueueItems that are scheduled after lvalert_listenMP stops waiting (t0+timeout) contribute None to results without delaying the reply,
+    and QueueItems that are removed before they are executed contribute None along with an error (see sweepRequests).
+    All other alerts are answered as soon as they have been passed to parseAlert.
+
+    lvalert_listenMP may also push new values for sleep, maxComplete, maxFrac, warnThr, recipients, warnDelay and maxWarn when its config is reloaded
+        {'type':'params', 'params':{name:value, ...}}
+    these are validated with lvalertMPutils.checkParam and no reply is sent
+    The same parameters can be changed by commands (setParams) through queue.params
     """
+    signal.signal(signal.SIGHUP, signal.SIG_IGN) ### lvalert_listenMP reloads its config on SIGHUP, which should not affect its children
+    signal.signal(signal.SIGTERM, __terminate__) ### lvalert_listenMP stops its children with SIGTERM, after which we still flush the log
+
     ### load in config file
     config = ConfigParser.SafeConfigParser()
     config.read( config_filename )
@@ -112,40 +438,91 @@ def interactiveQueue(connection, config_filename, verbose=True, sleep=0.1, maxCo
     logDir       = config.get('general', 'log_directory') if config.has_option('general', 'log_directory') else "."
     logLevel     = config.getint('general', 'log_level') if config.has_option('general', 'log_level') else 10
 
+    ### parameters about how much of each alert we log
+    payloadSize   = config.getint('general', 'log_payload_size') if config.has_option('general', 'log_payload_size') else 0 ### truncate logged payloads to this many characters. 0 means no limit
+    payloadSample = config.getfloat('general', 'log_payload_sample') if config.has_option('general', 'log_payload_sample') else 1.0 ### the fraction of payloads that are logged
+
+    ### parameters about coalescing alerts for the same GraceID
+    coalesceWindow = config.getfloat('general', 'coalesce_window') if config.has_option('general', 'coalesce_window') else 0 ### merge alerts with the same uid and alert_type that arrive within this many seconds. 0 means never
+    coalesceTypes  = config.get('general', 'coalesce_alert_types').split() if config.has_option('general', 'coalesce_alert_types') else [] ### only coalesce these alert_types. Empty means all
+
+    ### parameters about dropping duplicate payloads
+    dedupSize = config.getint('general', 'dedup_size') if config.has_option('general', 'dedup_size') else 0 ### remember at most this many payloads. 0 means we do not look for duplicates
+    dedupTTL  = config.getfloat('general', 'dedup_ttl') if config.has_option('general', 'dedup_ttl') else 600 ### forget payloads after this many seconds
+
+    ### priorities for QueueItems by name (smaller values are more urgent). These override the items' own priorities
+    priorities = dict((name, config.getint('priority', name)) for name in config.options('priority')) if config.has_section('priority') else {}
+
+    ### parameters about what we do when len(queue) > warnThr
+    overloadPolicy   = config.get('general', 'overload_policy').split() if config.has_option('general', 'overload_policy') else [] ### any of "shed", "delay", "collapse", "throttle"
+    overloadPriority = config.getint('general', 'overload_priority') if config.has_option('general', 'overload_priority') else 1 ### only items with priority >= this are shed or collapsed
+    overloadInterval = config.getfloat('general', 'overload_interval') if config.has_option('general', 'overload_interval') else 1.0 ### the minimum time between applications of "shed" and "collapse"
+    throttleDuration = config.getfloat('general', 'throttle_duration') if config.has_option('general', 'throttle_duration') else 60.0 ### how long the parent stops sending us alerts
+    delaySize        = config.getint('general', 'delay_size') if config.has_option('general', 'delay_size') else 1000 ### the maximum number of alerts held by "delay"
+    delayOverflow    = config.get('general', 'delay_overflow') if config.has_option('general', 'delay_overflow') else 'oldest' ### which alert "delay" drops when it already holds delay_size alerts
+    for policy in overloadPolicy:
+        if policy not in ['shed', 'delay', 'collapse', 'throttle']:
+            raise ValueError('overload_policy=%s not understood'%policy)
+    if delaySize < 1:
+        raise ValueError('delay_size must be positive')
+    if delayOverflow not in ['oldest', 'newest']:
+        raise ValueError('delay_overflow=%s not understood'%delayOverflow)
+
+    ### parameters about how long we wait between epochs
+    adaptiveSleep = config.getboolean('general', 'adaptive_sleep') if config.has_option('general', 'adaptive_sleep') else False ### if True, we ignore sleep and wait until something needs attention, waking as soon as an alert arrives
+    maxSleep      = config.getfloat('general', 'max_sleep') if config.has_option('general', 'max_sleep') else 1.0 ### the longest we wait between epochs when adaptive_sleep=True
+
+    ### parameters about sharing execution between GraceIDs
+    graceidRate  = config.getfloat('general', 'graceid_rate') if config.has_option('general', 'graceid_rate') else 0 ### the maximum number of QueueItems executed per second for any one GraceID. 0 means unlimited
+    graceidBurst = config.getfloat('general', 'graceid_burst') if config.has_option('general', 'graceid_burst') else None ### how many QueueItems a GraceID may execute back-to-back. Defaults to max(1, graceid_rate)
+    graceidFair  = config.getboolean('general', 'graceid_fair') if config.has_option('general', 'graceid_fair') else False ### if True, GraceIDs take turns when more than one has expired items
+    if graceidRate < 0:
+        raise ValueError('graceid_rate must be non-negative')
+
+    ### the longest (sec) a single QueueItem may execute before we interrupt it. 0 means no limit
+    itemDeadline = config.getfloat('general', 'item_deadline') if config.has_option('general', 'item_deadline') else 0
+
+    ### the number of failed QueueItems we remember (see commands.DeadLettersTask)
+    deadLetterSize = config.getint('general', 'dead_letter_size') if config.has_option('general', 'dead_letter_size') else 100
+
+    ### parameters about log rotation
+    logMaxBytes    = config.getint('general', 'log_max_bytes') if config.has_option('general', 'log_max_bytes') else 0 ### rotate once the log is this big. 0 means never
+    logInterval    = config.getfloat('general', 'log_rotate_interval') if config.has_option('general', 'log_rotate_interval') else 0 ### rotate after this many seconds. 0 means never
+    logBackupCount = config.getint('general', 'log_backup_count') if config.has_option('general', 'log_backup_count') else 0 ### keep this many rotated segments. 0 means keep everything
+    logCompress    = config.getboolean('general', 'log_compress') if config.has_option('general', 'log_compress') else False ### gzip rotated segments
+
     ### set up logger
     ### this logger will capture *everything* that is printed through a child logger
+    listener = None ### writes log records in a separate thread, stopped once we exit
     if verbose:
-        logger = logging.getLogger("iQ")
+        logger = utils.getLogger("iQ")
         logger.setLevel(logLevel) ### NOTE: may want to make this an option in config file
 
         ### set up handlers
         # into a file with a predictable filename
-        handlers = [logging.FileHandler(utils.genLogname(logDir, process_type+'_'+os.path.basename(config_filename).strip('.ini')))]
+        logname = utils.genLogname(logDir, process_type+'_'+os.path.basename(config_filename).strip('.ini'))
+        if logMaxBytes or logInterval: ### rotate the log
+            handlers = [utils.RotatingLogHandler(logname, maxBytes=logMaxBytes, interval=logInterval, backupCount=logBackupCount, compress=logCompress)]
+        else:
+            handlers = [logging.FileHandler(logname)]
         if print2stdout:
             handlers.append(logging.StreamHandler())
 
         for handler in handlers:
             handler.setFormatter( utils.genFormatter() )
-            logger.addHandler( handler )
 
-        logger.info( "using config : %s"%config_filename )
-        logger.info( "initializing process_type : %s"%process_type )
+        ### handlers are only called from a separate thread, so file I/O does not block this loop
+        listener = utils.genQueueLogging( logger, handlers )
 
-    ### set up libraries depending on process_type
-    if process_type=="test":
-        from parseAlert import parseAlert
-
-    elif process_type=="event_supervisor":
-        from eventSupervisor.eventSupervisor import parseAlert
-
-    elif process_type=="approval_processorMP":
-        from approval_processorMP.approval_processorMPutils import parseAlert
+        logger.info( "using config : %s", config_filename )
+        logger.info( "initializing process_type : %s", process_type )
 
-    else:
-        raise ValueError("process_type=%s not understood"%process_type)
+    ### set up libraries depending on process_type
+    ### this is cached if lvalert_listenMP preloaded it before forking
+    parseAlert = getParseAlert( process_type )
 
     ### set up queue
-    queue          = utils.SortedQueue() ### instantiate the queue
+    queue          = utils.SortedQueue(priorities=priorities) ### instantiate the queue
     queueByGraceID = {} ### hold shorter SortedQueue's, one for each GraceID
 
     ### set up warnings
@@ -155,41 +532,194 @@ def interactiveQueue(connection, config_filename, verbose=True, sleep=0.1, maxCo
     hostname = socket.gethostbyaddr(socket.gethostname())[0]
     username = getpass.getuser()
 
-    ### iterate
-    while True:
-        start = time.time()
-
-        ### look for new data in the connection
-	print connection.poll()
-        if connection.poll():
-
-            ### this blocks until there is something to recieve, which is why we checked first!
-            e, t0 = connection.recv()
-            if verbose:
-                logger.info( "received : %s"%e )
-
-            try:
-                e = json.loads(e)
+    ### set up the cache of payloads used to drop duplicates
+    if dedupSize > 0:
+        dedup = utils.DedupCache(maxSize=dedupSize, ttl=dedupTTL)
+    else:
+        dedup = None
+
+    ### set up overload policies
+    overloadTime = -infty ### the next time we can shed or collapse items
+    throttleTime = -infty ### the next time we can ask the parent to stop sending alerts
+    delayed = collections.deque() ### (alert, t0) that arrived while we were overloaded
+
+    ### parameters that can be changed while we are running
+    params = dict(zip(utils.paramNames, [sleep, maxComplete, maxFrac, warnThr, recipients, warnDelay, maxWarn]))
+    queue.params = params ### exposed to Tasks (eg: commands.SetParamsTask) through the queue
+
+    ### statistics about how long we wait between epochs, exposed to Tasks (eg: commands.QueueStatsTask) through the queue
+    loopStats = {
+        'adaptive'    : adaptiveSleep,
+        'period'      : sleep, ### the most recent time we waited between epochs
+        'epochs'      : 0,     ### the number of epochs
+        'busyEpochs'  : 0,     ### the number of epochs after which we did not wait at all
+        'waited'      : 0.0,   ### the total time we asked to wait
+        'adjustments' : 0,     ### the number of times we switched between waiting and not waiting
+        'rateLimited' : 0,     ### the number of epochs in which expired QueueItems were held back by graceid_rate
+        'deadlines'   : 0,     ### the number of QueueItems interrupted because they ran past a deadline
+        'delayDropped': 0,     ### the number of alerts dropped because "delay" already held delay_size alerts
+        'dedupHits'   : 0,     ### the number of alerts dropped as duplicates (see dedup_size)
+        'dedupMisses' : 0,     ### the number of alerts checked for duplicates that were not dropped
+    }
+    queue.loopStats = loopStats
+
+    ### records of QueueItems that failed, exposed to Tasks (eg: commands.DeadLettersTask) through the queue
+    deadLetters = collections.deque(maxlen=deadLetterSize)
+    queue.deadLetters = deadLetters
+
+    ### state used to share execution between GraceIDs
+    buckets = utils.TokenBuckets(graceidRate, burst=graceidBurst) if graceidRate else None
+    lastServed = {} ### graceid -> the epoch in which we last executed a QueueItem for that graceid
+
+    ### replies we owe to lvalert_listenMP's control socket
+    requests = {} ### rid -> reply that is sent once all QueueItems associated with rid have been executed
 
-            except Exception:
-                trcbk = traceback.format_exc().strip("\n")
-                if verbose:
-                    logger.warn( 'could not parse lvalert payload!' )
-                    logger.warn( trcbk )
-
-                if recipients:
-                    utils.sendEmail( 
-                        recipients, 
-                        lvalert_body%(time.ctime(t0), e, trcbk, username, hostname, config_filename), 
-                        lvalert_subject%(hostname),
-                    )
-
-            ### parse the message and insert the appropriate item into the queuie
-            ### only do this if "e" was successfully parsed into a dictionary
-            else:
+    ### iterate
+    try:
+        while True:
+            start = utils.monotonic()
+
+            ### look for new data in the connection
+            if connection.poll():
+
+                ### this blocks until there is something to recieve, which is why we checked first!
+                msg = connection.recv()
+                if isinstance(msg, dict) and (msg.get('type')=='params'): ### new parameters pushed by lvalert_listenMP when its config is reloaded
+                    try:
+                        changes = utils.updateParams( params, msg['params'] )
+                    except ValueError:
+                        if verbose:
+                            logger.warn( 'could not update parameters!' )
+                            logger.warn( traceback.format_exc().strip("\n") )
+                    else:
+                        sleep, maxComplete, maxFrac, warnThr, recipients, warnDelay, maxWarn = [params[name] for name in utils.paramNames]
+                        if verbose:
+                            for name in sorted(changes.keys()):
+                                logger.info( "updated parameter %s : %s -> %s", name, changes[name][0], changes[name][1] )
+
+                else:
+                    if isinstance(msg, dict): ### a request from lvalert_listenMP's control socket, which expects a reply
+                        e, t0, rid = msg['payload'], msg['t0'], msg['rid']
+                        deadline = utils.wall2mono(t0+msg.get('timeout', infty)) ### when lvalert_listenMP stops waiting for the reply
+                    else: ### a plain alert
+                        e, t0 = msg
+                        rid = None
+                    wallt0 = t0 ### the wall-clock time at which lvalert_listenMP received this alert
+                    t0 = utils.wall2mono(t0) ### everything else uses the clock on which expirations are tracked
+
+                    payload = e ### the raw payload, used to recognize duplicates
+                    if verbose and logger.isEnabledFor(logging.INFO) and ((payloadSample >= 1) or (random.random() < payloadSample)):
+                        ### lines that do not contain a complete record of what we received are marked so lvalert_replayMP skips them
+                        marks = ['sampled'] if payloadSample < 1 else []
+                        if (payloadSize > 0) and (len(e) > payloadSize):
+                            marks.append( 'truncated' )
+                        if marks:
+                            logger.info( "received (%s) : %s", ", ".join(marks), utils.truncate(e, payloadSize) )
+                        else:
+                            logger.info( "received : %s", e )
+
+                    try:
+                        e = json.loads(e)
+
+                    except Exception:
+                        trcbk = traceback.format_exc().strip("\n")
+                        if verbose:
+                            logger.warn( 'could not parse lvalert payload!' )
+                            logger.warn( trcbk )
+
+                        if recipients:
+                            utils.sendEmail( 
+                                recipients, 
+                                lvalert_body%(time.ctime(utils.mono2wall(t0)), e, trcbk, username, hostname, config_filename), 
+                                lvalert_subject%(hostname),
+                            )
+
+                        if rid is not None:
+                            connection.send( {'type':'reply', 'rid':rid, 'status':'error', 'results':[], 'error':trcbk} )
+
+                    ### parse the message and insert the appropriate item into the queuie
+                    ### only do this if "e" was successfully parsed into a dictionary
+                    else:
+                        duplicate = (dedup is not None) and (rid is None) and isinstance(e, dict) and (e.get('uid', None) not in ['command', 'heartbeat']) and dedup.seen(payload, now=t0)
+                        if dedup is not None: ### exposed through queueStats
+                            loopStats['dedupHits'] = dedup.hits
+                            loopStats['dedupMisses'] = dedup.misses
+
+                        if duplicate: ### an exact duplicate of a recent alert (eg: a retry), so we drop it
+                            if verbose:
+                                logger.debug( "dropping duplicate payload (hits=%d, misses=%d)", dedup.hits, dedup.misses )
+
+                        else:
+                            try:
+                                if (rid is not None) and (e['uid']=='command'): ### build the QueueItems here so we can reply after they are executed
+                                    items = commands.genQueueItems( queue, queueByGraceID, e, t0 )
+                                    waitFor = [item for item in items if item.expiration <= deadline] ### the rest will not be executed before lvalert_listenMP gives up
+                                    for item in waitFor:
+                                        item.rid = rid
+                                    if waitFor:
+                                        requests[rid] = {'type':'reply', 'rid':rid, 'status':'ok', 'results':[None]*(len(items)-len(waitFor)), 'remaining':len(waitFor), 'items':waitFor, 'deadline':deadline}
+                                    else: ### nothing to wait for (eg: an empty batch or everything sleeps for a long time)
+                                        connection.send( {'type':'reply', 'rid':rid, 'status':'ok', 'results':[None]*len(items)} )
+                                    commands.insertItems( queue, queueByGraceID, items )
+
+                                elif ('delay' in overloadPolicy) and (delayed or (len(queue) > warnThr)) and (e['uid'] not in ['command', 'heartbeat']): ### hold on to this until we are no longer overloaded
+                                    ### once anything is delayed, every new alert waits behind it so alerts are parsed in the order they arrived
+                                    if len(delayed) >= delaySize: ### make room according to delay_overflow
+                                        if delayOverflow=='oldest':
+                                            dropped, _ = delayed.popleft()
+                                            delayed.append( (e, t0) )
+                                        else:
+                                            dropped = e
+                                        loopStats['delayDropped'] += 1
+                                        if verbose:
+                                            logger.warn( "%d alerts are delayed; dropping the %s : %s", len(delayed), delayOverflow, utils.truncate(json.dumps(dropped), payloadSize) )
+                                    else:
+                                        delayed.append( (e, t0) )
+                                        if verbose:
+                                            logger.debug( "delaying alert; %d alerts are delayed", len(delayed) )
+
+                                    if rid is not None:
+                                        connection.send( {'type':'reply', 'rid':rid, 'status':'ok', 'results':[]} )
+
+                                else:
+                                    if coalesceWindow and (e['uid'] not in ['command', 'heartbeat']) and ((not coalesceTypes) or (e.get('alert_type', None) in coalesceTypes)):
+                                        item = utils.coalesce( queueByGraceID, e, t0, coalesceWindow )
+                                    else:
+                                        item = None
+
+                                    if item is not None: ### merged into an existing QueueItem, so we don't need parseAlert
+                                        if verbose:
+                                            logger.debug( "coalesced alert into : %s", item.description )
+                                    else:
+                                        parseAlert( queue, queueByGraceID, e, t0, config )
+
+                                    if rid is not None:
+                                        connection.send( {'type':'reply', 'rid':rid, 'status':'ok', 'results':[]} )
+
+                            except Exception:
+                                trcbk = traceback.format_exc().strip("\n")
+                                if verbose:
+                                    logger.warn( 'parseAlert raised an exception!' )
+                                    logger.warn( trcbk )
+
+                                if recipients:
+                                    utils.sendEmail( 
+                                        recipients, 
+                                        parseAlert_body%(time.ctime(utils.mono2wall(t0)), json.dumps(e), trcbk, username, hostname, config_filename), 
+                                        parseAlert_subject%(hostname),
+                                    )
+
+                                if rid is not None:
+                                    connection.send( {'type':'reply', 'rid':rid, 'status':'error', 'results':[], 'error':trcbk} )
+
+                    if ack: ### report back that we've handled this alert
+                        connection.send( {'type':'ack', 't0':wallt0, 'time':time.time()} )
+
+            ### release delayed alerts, oldest first, until we are overloaded again
+            while delayed and (len(queue) <= warnThr):
+                e, t0 = delayed.popleft()
                 try:
                     parseAlert( queue, queueByGraceID, e, t0, config )
-
                 except Exception:
                     trcbk = traceback.format_exc().strip("\n")
                     if verbose:
@@ -199,108 +729,205 @@ def interactiveQueue(connection, config_filename, verbose=True, sleep=0.1, maxCo
                     if recipients:
                         utils.sendEmail( 
                             recipients, 
-                            parseAlert_body%(time.ctime(t0), json.dumps(e), trcbk, username, hostname, config_filename), 
+                            parseAlert_body%(time.ctime(utils.mono2wall(t0)), json.dumps(e), trcbk, username, hostname, config_filename), 
                             parseAlert_subject%(hostname),
                         )
 
-        ### remove any completed tasks from the front of the queue
-        while len(queue) and queue[0].complete: ### skip all things that are complete already
-            item = queue.pop(0) ### note, we expect this to have been removed from queueByGraceID already
-            if verbose:
-                logger.debug( "ALREADY COMPLETE: "+item.description )
+            ### remove any completed tasks from the front of the queue
+            while len(queue) and queue[0].complete: ### skip all things that are complete already
+                item = queue.pop(0) ### note, we expect this to have been removed from queueByGraceID already
+                if verbose:
+                    logger.debug( "ALREADY COMPLETE: %s", item.description )
 
-        ### iterate through queue and check for expired things...
-        if len(queue):
-            if queue[0].hasExpired():
-                item = queue.pop(0)
+            ### iterate through queue and check for expired things...
+            ind = queue.nextExpired(utils.monotonic()) ### the first expired item from the most urgent lane
+            while (ind is not None) and queue[ind].complete: ### skip things that are complete already
+                item = queue.pop(ind) ### note, we expect this to have been removed from queueByGraceID already
+                if verbose:
+                    logger.debug( "ALREADY COMPLETE: %s", item.description )
+                ind = queue.nextExpired(utils.monotonic())
+
+            held = False ### whether expired items were held back by graceid_rate
+            if (ind is not None) and (graceidFair or (buckets is not None)):
+                ind = utils.nextFair(queue, queueByGraceID, utils.monotonic(), lastServed if graceidFair else {}, buckets=buckets)
+                if ind is None:
+                    held = True
+                    loopStats['rateLimited'] += 1
+
+            if ind is not None:
+                item = queue.pop(ind)
+                if hasattr(item, 'graceid'):
+                    if buckets is not None:
+                        buckets.take(item.graceid, utils.monotonic())
+                    if graceidFair:
+                        lastServed[item.graceid] = loopStats['epochs']
+                    graceKey = queueByGraceID[item.graceid].key(item) if queueByGraceID.has_key(item.graceid) else None ### lets us find item again with a binary search
                 if verbose:
-                    logger.info( "performing : %s"%(item.description) )
+                    logger.info( "performing : %s", item.description )
 
                 ### now, actually do something with that item
                 try: 
-                    item.execute( verbose=verbose ) 
+                    utils.callWithDeadline( itemDeadline, item.execute, verbose=verbose ) ### Tasks may also set their own (shorter) deadlines
 
-                except Exception:
+                    if hasattr(item, 'rid'): ### someone is waiting for the results
+                        reply(connection, requests, item, [getattr(task, 'result', None) for task in item.completedTasks+item.tasks])
+
+                except (Exception, utils.DeadlineExceeded) as e:
                     item.complete = True ### mark this as complete so we don't repeatedly hit the same error
                                          ### NOTE: this may cause other formatting errors if this item modified queue or queueByGraceId
                                          ###       and failed before those were complete...
+                    if isinstance(e, utils.DeadlineExceeded):
+                        loopStats['deadlines'] += 1
 
                     trcbk = traceback.format_exc().strip("\n")
+                    deadLetters.append( utils.deadLetter(item, trcbk) )
                     if verbose:
-                        logger.warn( '%s\'s execute raised an exception! Marking QueueItem as complete to avoid repeated errors.'%item.name )
+                        logger.warn( '%s\'s execute raised an exception! Marking QueueItem as complete to avoid repeated errors.', item.name )
                         logger.warn( trcbk )
 
                     if recipients:
                         utils.sendEmail( 
                             recipients, 
-                            execute_body%(time.ctime(t0), item.name, item.description, trcbk, username, hostname, config_filename),
+                            execute_body%(time.ctime(utils.mono2wall(t0)), item.name, item.description, trcbk, username, hostname, config_filename),
                             execute_subject%(item.name, hostname),
                         )
 
+                    if hasattr(item, 'rid'):
+                        reply(connection, requests, item, [], error=trcbk)
+
+                ### item may have changed our parameters (eg: setParams)
+                sleep, maxComplete, maxFrac, warnThr, recipients, warnDelay, maxWarn = [params[name] for name in utils.paramNames]
+
+                ### item was popped from queue while it executed so that it cannot see (or checkpoint) itself, which is why we re-insert it into queue
+                ### but it stayed in queueByGraceID, where we move it in place. Commands (eg: clearGraceID) may already have removed it from there
                 if item.complete: ### item is now complete, so we remove it from the queue
                     ### remove this item from queueByGraceID
-                    if hasattr(item, 'graceid'): ### QueueItems are not required to have a graceid attribute, but if they do we should manage queueByGraceID
-                        queueByGraceID[item.graceid].pop(0) ### this *must* be the first item in this queue too!
+                    if hasattr(item, 'graceid') and queueByGraceID.has_key(item.graceid): ### QueueItems are not required to have a graceid attribute, but if they do we should manage queueByGraceID
+                        try:
+                            queueByGraceID[item.graceid].remove( item, key=graceKey ) ### this may not be the first item if it has a different priority than other items for this graceid
+                        except ValueError: ### already removed
+                            pass
                         if not len(queueByGraceID[item.graceid]): ### nothing left in this queue
                             queueByGraceID.pop(item.graceid) ### remove the key from the dictionary
 
                 else: ### item is not complete, so we re-insert it into the queue
                     queue.insert( item )
                     if hasattr(item, 'graceid'): ### QueueItems are not required to have a graceid attribute, but if they do we should manage queueByGraceID
-                        queueByGraceID[item.graceid].insert( queueByGraceID[item.graceid].pop(0) ) ### pop and re-insert
-
-            else:
-                pass ### do nothing
-
-        ### clean up any empty lists within queueByGraceID
-        for graceid in queueByGraceID.keys():
-            if not len(queueByGraceID[graceid]): ### nothing in this lists
-               queueByGraceID.pop(graceid) ### remove this key from the dictionary
+                        if not queueByGraceID.has_key(item.graceid):
+                            queueByGraceID[item.graceid] = utils.SortedQueue()
+                        try:
+                            queueByGraceID[item.graceid].reschedule( item, graceKey ) ### move item to match its new expiration
+                        except ValueError: ### no longer there, so we add it back
+                            queueByGraceID[item.graceid].insert( item )
+
+            ### clean up any empty lists within queueByGraceID
+            for graceid in queueByGraceID.keys():
+                if not len(queueByGraceID[graceid]): ### nothing in this lists
+                   queueByGraceID.pop(graceid) ### remove this key from the dictionary
+
+            ### forget GraceIDs we no longer need to share execution with
+            if lastServed:
+                for graceid in lastServed.keys():
+                    if not queueByGraceID.has_key(graceid):
+                        lastServed.pop(graceid)
+            if buckets is not None:
+                buckets.prune(utils.monotonic())
  
-        ### check to see if we have too many complete processes in the queue
-        if queue.complete > min(len(queue)*maxFrac, maxComplete):
-            queue.clean()
+            ### check to see if we have too many complete processes in the queue
+            if queue.complete > min(len(queue)*maxFrac, maxComplete):
+                queue.clean()
+
+            ### apply overload policies
+            if len(queue) > warnThr:
+                if utils.monotonic() > overloadTime:
+                    size = len(queue)
+                    N = 0
+                    if 'collapse' in overloadPolicy: ### only keep the most recent item for each GraceID
+                        N += utils.collapse( queue, queueByGraceID, priority=overloadPriority )
+                    if 'shed' in overloadPolicy: ### drop the least urgent items
+                        N += utils.shed( queue, queueByGraceID, len(queue)-queue.complete-warnThr, priority=overloadPriority )
+                    if N:
+                        queue.clean()
+                        if verbose:
+                            logger.warn( "len(queue)=%d > %d=warnThr; removed %d QueueItems", size, warnThr, N )
+                    overloadTime = utils.monotonic()+overloadInterval
+
+                if ('throttle' in overloadPolicy) and (len(queue) > warnThr) and (utils.monotonic() > throttleTime): ### still overloaded, so ask the parent to stop sending us alerts for a while
+                    connection.send( {'type':'throttle', 'duration':throttleDuration} )
+                    throttleTime = utils.monotonic()+throttleDuration
+                    if verbose:
+                        logger.warn( "len(queue)=%d > %d=warnThr; asked lvalert_listenMP to stop sending alerts for %.1f sec", len(queue), warnThr, throttleDuration )
 
-        ### check len(queue) and send warnings
-        if len(queue) > warnThr: ### queue is too long
-            if time.time() > warnTime: ### it's not too soon to send another warning
-                warnCount += 1
-                if recipients: ### send with emails
-                    if warnCount <= maxWarn: ### we should still send out a warning
-                        ### set up the message
-                        subject = warning_subject%(hostname)
-                        body    = warning_body%(warnThr, len(queue), username, hostname, config_filename, warnCount)
+            ### reply for requested QueueItems that were dropped without being executed
+            if requests:
+                sweepRequests( connection, requests, queue, utils.monotonic() )
 
-                        if warnCount == maxWarn: ### this is our last warning before silencing, augment message
-                            subject = "FINAL "+subject
-                            body    = body + "This is the final warning!"
+            ### check len(queue) and send warnings
+            if len(queue) > warnThr: ### queue is too long
+                if utils.monotonic() > warnTime: ### it's not too soon to send another warning
+                    warnCount += 1
+                    if recipients: ### send with emails
+                        if warnCount <= maxWarn: ### we should still send out a warning
+                            ### set up the message
+                            subject = warning_subject%(hostname)
+                            body    = warning_body%(warnThr, len(queue), username, hostname, config_filename, warnCount)
 
-                        utils.sendEmail( recipients, body, subject )
+                            if warnCount == maxWarn: ### this is our last warning before silencing, augment message
+                                subject = "FINAL "+subject
+                                body    = body + "This is the final warning!"
 
-                    else: ### we've already sent the maximum allowed warnings
-                        pass
+                            utils.sendEmail( recipients, body, subject )
 
-                if verbose:
-                    logger.warn( "len(queue)=%d >= %d=warnThr; emails sent to : %s"%(len(queue), warnThr, ", ".join(recipients)) )
+                        else: ### we've already sent the maximum allowed warnings
+                            pass
+
+                    if verbose:
+                        logger.warn( "len(queue)=%d >= %d=warnThr; emails sent to : %s", len(queue), warnThr, ", ".join(recipients) )
 
-                warnTime = time.time()+warnDelay ### update time when we'll send the next warning
+                    warnTime = utils.monotonic()+warnDelay ### update time when we'll send the next warning
 
-        elif warnCount > 0: ### we've sent warnings
-            if recipients: ### send RECOVERY notice
-                body = recovery_body%(warnThr, len(queue), username, hostname, config_filename)
+            elif warnCount > 0: ### we've sent warnings
+                if recipients: ### send RECOVERY notice
+                    body = recovery_body%(warnThr, len(queue), username, hostname, config_filename)
 
-                if warnCount >= maxWarn: ### we've silence warnings
-                    body = body + "Recovery has un-silenced warnings."
+                    if warnCount >= maxWarn: ### we've silence warnings
+                        body = body + "Recovery has un-silenced warnings."
 
-                utils.sendEmail( recipients, body, recovery_subject%(hostname) ) 
+                    utils.sendEmail( recipients, body, recovery_subject%(hostname) ) 
 
-            if verbose: ### print RECOVERY notice
-                logger.warn( "len(queue)=%d <= %d=warnThr; emails sent to : %s"%(len(queue), warnThr, ", ".join(recipients)) )
+                if verbose: ### print RECOVERY notice
+                    logger.warn( "len(queue)=%d <= %d=warnThr; emails sent to : %s", len(queue), warnThr, ", ".join(recipients) )
  
-            warnCount = 0  ### reset this counter because we've recovered
-            warnTime = -infty ### reset time of last warning to ensure we send one if things go bad again
+                warnCount = 0  ### reset this counter because we've recovered
+                warnTime = -infty ### reset time of last warning to ensure we send one if things go bad again
+
+            ### sleep if needed
+            if adaptiveSleep: ### wait until something needs attention, but return as soon as an alert arrives
+                if connection.poll() or (delayed and (len(queue) <= warnThr)) or ((not held) and (queue.nextExpired(utils.monotonic()) is not None)):
+                    wait = 0
+                elif held and (buckets is not None): ### nothing we may execute until a GraceID earns another token
+                    wait = min(maxSleep, 1.0/graceidRate)
+                else:
+                    wait = min(maxSleep, max(0, queue.nextExpiration()-utils.monotonic()))
+            else:
+                wait = max(0, (start+sleep)-utils.monotonic())
 
-        ### sleep if needed
-        wait = (start+sleep)-time.time() 
-        if wait > 0:
-            time.sleep(wait)
+            if (wait > 0)!=(loopStats['period'] > 0):
+                loopStats['adjustments'] += 1
+                if verbose:
+                    logger.debug( "epoch period : %.3f -> %.3f sec", loopStats['period'], wait )
+            loopStats['period'] = wait
+            loopStats['epochs'] += 1
+            loopStats['waited'] += wait
+            if not wait:
+                loopStats['busyEpochs'] += 1
+
+            if wait > 0:
+                if adaptiveSleep:
+                    connection.poll(wait)
+                else:
+                    time.sleep(wait)
+
+    finally:
+        if listener is not None: ### write any records that remain and stop the thread
+            listener.stop()
@@ -3,28 +3,231 @@ author = "reed.essick@ligo.org"
 
 #---------------------------------------------------------------------------------------------------
 
-from numpy import infty
-
 import subprocess as sp
 
+import bisect
+import itertools
+import operator
+
+import os
+import gc
 import time
+import random
+import signal
+import json
+import gzip
+import shutil
+import hashlib
+
+from collections import OrderedDict
 
 import logging
+import threading
+import Queue
+
+infty = float('inf') ### used instead of numpy.infty so we do not have to import numpy
 
 #---------------------------------------------------------------------------------------------------
 
-def sendEmail( recipients, body, subject ):
+### expirations are compared against a monotonic clock so that stepping the wall clock (eg: NTP) neither makes the whole queue expire
+### at once nor stalls it. The clock is anchored to the wall clock when this module is imported, so its values stay close to time.time()
+### and Tasks that still compute expirations from time.time() keep working (up to any steps since we started)
+
+def __rawMonotonic__():
+    """
+    returns the best monotonic clock we can find
+    python2 does not provide time.monotonic, so we call clock_gettime(CLOCK_MONOTONIC) through ctypes and fall back to time.time
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1 ### from <linux/time.h>
+
+        def monotonic():
+            t = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)):
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return t.tv_sec + t.tv_nsec*1e-9
+
+        monotonic() ### make sure this actually works
+        return monotonic
+
+    except Exception: ### no ctypes, no librt, not linux...
+        return time.time
+
+__monotonic__ = __rawMonotonic__()
+__monotonicOffset__ = time.time() - __monotonic__() ### anchors the monotonic clock to the wall clock
+
+def monotonic():
+    """
+    returns the time according to a monotonic clock that agreed with time.time() when this module was imported
+    """
+    return __monotonic__() + __monotonicOffset__
+
+__clockStep__ = None ### when set (see FixedClockStep), clockStep returns this instead of reading both clocks
+
+def clockStep():
+    """
+    returns how far the wall clock has been stepped relative to monotonic since this module was imported
+    rounded to the nearest millisecond so that the time between reading the two clocks does not matter and conversions round-trip exactly
+    """
+    if __clockStep__ is not None:
+        return __clockStep__
+    return round(time.time() - monotonic(), 3)
+
+class FixedClockStep(object):
+    """
+    a context manager within which clockStep is read once and reused
+    every conversion within the block agrees and we avoid reading both clocks for each object, eg: while (un)pickling a large queue
+    """
+
+    def __enter__(self):
+        global __clockStep__
+        self.previous = __clockStep__
+        __clockStep__ = clockStep()
+        return self
+
+    def __exit__(self, *args):
+        global __clockStep__
+        __clockStep__ = self.previous
+
+class PauseGC(object):
+    """
+    a context manager within which garbage collection is paused
+    used while loading a large queue, because the collector would otherwise repeatedly (and needlessly) scan the many new objects we create
+    """
+
+    def __enter__(self):
+        self.enabled = gc.isenabled()
+        gc.disable()
+        return self
+
+    def __exit__(self, *args):
+        if self.enabled:
+            gc.enable()
+
+def wall2mono(t):
+    """
+    translates a wall-clock time (eg: from time.time()) into the clock used for expirations (see monotonic)
+    """
+    return t - clockStep()
+
+def mono2wall(t):
+    """
+    translates a time from the clock used for expirations (see monotonic) into a wall-clock time
+    """
+    return t + clockStep()
+
+#---------------------------------------------------------------------------------------------------
+
+class DeadlineExceeded(BaseException):
+    """
+    raised when something runs past its deadline (see callWithDeadline and CancelToken)
+    like KeyboardInterrupt, this does not derive from Exception so that "except Exception" within the code we interrupt cannot swallow it
+    catch it explicitly where a deadline is expected
+    """
+    pass
+
+def __alarm__(signum, frame):
+    raise DeadlineExceeded('deadline exceeded')
+
+def callWithDeadline(seconds, foo, *args, **kwargs):
+    """
+    returns foo(*args, **kwargs), interrupting it with DeadlineExceeded if it runs longer than seconds
+    we use SIGALRM, so this only interrupts foo in the main thread and foo cannot be interrupted while it is inside a single C call that retries after signals.
+    From other threads (or if seconds is None or 0), we simply call foo
+
+    deadlines can be nested. An earlier deadline that is already set stays in charge and is restored when we return
+    """
+    if not seconds:
+        return foo(*args, **kwargs)
+    try:
+        handler = signal.signal(signal.SIGALRM, __alarm__)
+    except ValueError: ### not the main thread
+        return foo(*args, **kwargs)
+
+    outer = signal.getitimer(signal.ITIMER_REAL)[0] ### the time left on a deadline that is already set
+    adopted = bool(outer) and (outer <= seconds) ### the outer deadline comes first, so we just let it fire
+    start = monotonic()
+    signal.setitimer(signal.ITIMER_REAL, outer if adopted else seconds)
+    try:
+        return foo(*args, **kwargs)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, handler)
+        if outer and not adopted: ### restore the outer deadline
+            signal.setitimer(signal.ITIMER_REAL, max(1e-3, outer-(monotonic()-start)))
+
+class CancelToken(object):
+    """
+    lets long-running work check whether it has been cancelled or has run past its deadline
+    work that loops (or waits in small steps) should call check() regularly, which raises DeadlineExceeded once we are cancelled
+    """
+
+    def __init__(self, timeout=None):
+        self.deadline = monotonic()+timeout if timeout else infty
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def expired(self):
+        """
+        whether we have been cancelled or our deadline has passed
+        """
+        return self.cancelled or (monotonic() >= self.deadline)
+
+    def remaining(self):
+        """
+        the time (sec) until our deadline
+        """
+        return 0 if self.cancelled else max(0, self.deadline-monotonic())
+
+    def check(self):
+        """
+        raises DeadlineExceeded if we have expired
+        """
+        if self.expired():
+            raise DeadlineExceeded('cancelled' if self.cancelled else 'deadline exceeded')
+
+def runProcess(cmd, input=None, timeout=None):
+    """
+    runs cmd (a list) in a subprocess, passing input through stdin
+    if the subprocess runs longer than timeout (sec), or we are otherwise interrupted (eg: by an enclosing callWithDeadline), we kill it before raising
+
+    returns returncode, stdout, stderr
+    """
+    proc = sp.Popen(cmd, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
+    try:
+        out, err = callWithDeadline(timeout, proc.communicate, input=input)
+    except: ### including DeadlineExceeded and KeyboardInterrupt, so we never leave the subprocess behind
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        raise
+    return proc.returncode, out, err
+
+def sendEmail( recipients, body, subject, timeout=60 ):
     """
     a wrapper for the commands that send emails.
-    delegates to subprocess
+    delegates to subprocess, which is killed if it takes longer than timeout (sec)
 
     raises an error if returncode != 0
     """
     if not recipients:
         raise ValueError('recipients must not be an empty list')
-    proc = sp.Popen(["mail", "-s", subject]+recipients, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
-    out, err = proc.communicate(input=body)
-    if proc.returncode: ### there was an issue
+    returncode, out, err = runProcess(["mail", "-s", subject]+recipients, input=body, timeout=timeout)
+    if returncode: ### there was an issue
         raise RuntimeError('email failed to send\nstdout : %s\nstderr : %s'%(out, err))
 
 #---------------------------------------------------------------------------------------------------
@@ -48,20 +251,312 @@ def genFormatter():
     """
     return logging.Formatter('%(asctime)s | %(name)s : %(levelname)s : %(message)s')
 
+class QueueHandler(logging.Handler):
+    """
+    a Handler that puts records into a Queue.Queue instead of writing them anywhere
+    records are consumed (and written) by a QueueListener running in a separate thread
+    so that file I/O never blocks the thread that is logging
+
+    mirrors logging.handlers.QueueHandler from python3
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        """
+        merge args into the message and format any traceback so that the record can be formatted later
+        in another thread without referencing objects that may have changed in the meantime
+        """
+        record.msg = self.format(record) ### no formatter is set, so this just merges args and exc_info
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait( self.prepare(record) )
+        except Exception:
+            self.handleError(record)
+
+class QueueListener(object):
+    """
+    consumes records from a Queue.Queue within a daemon thread and passes them to handlers
+
+    mirrors logging.handlers.QueueListener from python3
+    """
+    sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        """
+        start the thread that consumes records
+        """
+        self.thread = threading.Thread(target=self.monitor)
+        self.thread.daemon = True ### we do not want this to keep the process alive
+        self.thread.start()
+
+    def monitor(self):
+        """
+        the target of self.thread. Passes records to handlers until we find self.sentinel
+        """
+        while True:
+            record = self.queue.get()
+            if record is self.sentinel:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """
+        write everything that remains in the queue and then stop the thread
+        """
+        self.queue.put_nowait( self.sentinel )
+        self.thread.join()
+        self.thread = None
+
+__loggers__ = {} ### loggers by (logTag, name) so we do not rebuild their names and look them up on every call
+
+def getLogger(logTag, name=None):
+    """
+    returns the logger named "logTag.name" (or just "logTag" if name is None)
+    loggers are cached so repeated calls on hot paths do not format names or acquire logging's lock
+    """
+    key = (logTag, name)
+    if not __loggers__.has_key(key):
+        __loggers__[key] = logging.getLogger(logTag if name is None else '%s.%s'%(logTag, name))
+    return __loggers__[key]
+
+__handlers__ = {} ### handlers that are shared by all loggers, so they are only ever instantiated once
+
+def getStreamHandler(name='stdout'):
+    """
+    returns a cached logging.StreamHandler without a formatter (so messages print exactly as supplied)
+    """
+    if not __handlers__.has_key(name):
+        __handlers__[name] = logging.StreamHandler()
+    return __handlers__[name]
+
+def addHandler(logger, handler):
+    """
+    adds handler to logger only if logger does not already have it
+    """
+    if handler not in logger.handlers:
+        logger.addHandler( handler )
+
+def genQueueLogging(logger, handlers):
+    """
+    routes everything logged through logger into a Queue.Queue and starts a QueueListener that writes to handlers in a separate thread
+
+    returns the QueueListener
+    """
+    queue = Queue.Queue() ### unbounded so that logging never blocks
+    listener = QueueListener(queue, *handlers)
+    listener.start()
+    logger.addHandler( QueueHandler(queue) )
+    return listener
+
+def truncate(string, size):
+    """
+    truncate string to at most size characters, noting how long it was originally
+    if size<=0, we return string unchanged
+    """
+    if (size > 0) and (len(string) > size):
+        return "%s... (truncated from %d characters)"%(string[:size], len(string))
+    return string
+
+def genIndexname(logname):
+    """
+    standardizes the naming convention for the index of rotated log segments
+
+    returns a string
+    """
+    return "%s.index"%logname
+
+def readIndex(logname):
+    """
+    reads the index of rotated segments for logname
+    each segment is described by a dictionary {'segment':path, 'start':time of first record, 'end':time of last record}
+    'start' is None if the segment was started by a previous process and we could not determine when
+
+    returns a list of dictionaries, ordered from oldest to newest
+    """
+    indexname = genIndexname(logname)
+    if not os.path.exists(indexname):
+        return []
+    file_obj = open(indexname, 'r')
+    index = [json.loads(line) for line in file_obj if line.strip()]
+    file_obj.close()
+    return index
+
+def findLogSegments(logname, start, end):
+    """
+    returns the paths of all log files (rotated segments and, if appropriate, logname itself) that may contain records between start and end
+    only the index is read, so this does not scan any of the log files
+    """
+    paths = []
+    last = -infty
+    for segment in readIndex(logname):
+        if (segment['start'] is None or segment['start'] <= end) and (segment['end'] >= start):
+            paths.append( segment['segment'] )
+        last = max(last, segment['end'])
+    if (end >= last) and os.path.exists(logname): ### the current file may contain records in this range
+        paths.append( logname )
+    return paths
+
+class RotatingLogHandler(logging.FileHandler):
+    """
+    a FileHandler that rotates logname once it exceeds maxBytes or once interval seconds have passed since it was started
+    rotated segments are renamed with the time at which they were started, optionally compressed with gzip,
+    and recorded in an index file (genIndexname) so that tools can find the segments for a time range via findLogSegments.
+    If backupCount > 0, only the most recent backupCount segments are kept.
+
+    NOTE: rotation happens within emit. When this is used behind a QueueHandler (as in interactiveQueue), this happens in the
+    QueueListener's thread so compression never delays the thread that is logging
+    """
+
+    def __init__(self, filename, maxBytes=0, interval=0, backupCount=0, compress=False):
+        self.maxBytes = maxBytes
+        self.interval = interval
+        self.backupCount = backupCount
+        self.compress = compress
+        logging.FileHandler.__init__(self, filename, mode='a')
+
+        ### if the file was started by a previous process, we do not know when its first record was written
+        self.newSegment = not (os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename))
+        self.segmentStart = None ### set by the first record in a new segment
+        self.segmentEnd = None ### updated with every record
+        self.rolloverAt = time.time()+self.interval
+
+    def shouldRollover(self, record):
+        """
+        determine whether we need to start a new segment before writing record
+        """
+        if self.interval > 0 and record.created >= self.rolloverAt:
+            return True
+        if self.maxBytes > 0:
+            self.stream.seek(0, 2) ### non-posix-compliant Windows feature
+            if self.stream.tell() + len(self.format(record)) >= self.maxBytes:
+                return True
+        return False
+
+    def doRollover(self):
+        """
+        close the current file, rename (and compress) it, record it in the index, and open a new file
+        """
+        self.stream.close()
+        self.stream = None
+
+        now = time.time()
+        if os.path.getsize(self.baseFilename): ### only keep segments that contain something
+            ### rename the current file
+            stamp = self.segmentStart if self.segmentStart is not None else now
+            stamp = "%s.%06d"%(time.strftime('%Y%m%d-%H%M%S', time.localtime(stamp)), int(1e6*(stamp%1))) ### segments sort by when they were started
+            segment = "%s.%s"%(self.baseFilename, stamp)
+            n = 0
+            while os.path.exists(segment) or os.path.exists(segment+'.gz'):
+                n += 1
+                segment = "%s.%s-%d"%(self.baseFilename, stamp, n)
+            os.rename(self.baseFilename, segment)
+
+            if self.compress:
+                src = open(segment, 'rb')
+                dst = gzip.open(segment+'.gz', 'wb')
+                shutil.copyfileobj(src, dst)
+                dst.close()
+                src.close()
+                os.remove(segment)
+                segment = segment+'.gz'
+
+            ### record this segment in the index
+            file_obj = open(genIndexname(self.baseFilename), 'a')
+            file_obj.write( json.dumps({'segment':segment, 'start':self.segmentStart, 'end':self.segmentEnd if self.segmentEnd is not None else now})+"\n" )
+            file_obj.close()
+
+            ### remove old segments
+            if self.backupCount > 0:
+                index = readIndex(self.baseFilename)
+                if len(index) > self.backupCount:
+                    for old in index[:-self.backupCount]:
+                        if os.path.exists(old['segment']):
+                            os.remove(old['segment'])
+                    file_obj = open(genIndexname(self.baseFilename), 'w')
+                    for new in index[-self.backupCount:]:
+                        file_obj.write( json.dumps(new)+"\n" )
+                    file_obj.close()
+
+        self.stream = self._open()
+        self.newSegment = True
+        self.segmentStart = None
+        self.segmentEnd = None
+        self.rolloverAt = now+self.interval
+
+    def emit(self, record):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.newSegment: ### first record in a new segment
+                self.segmentStart = record.created
+                self.newSegment = False
+            self.segmentEnd = record.created
+            logging.FileHandler.emit(self, record)
+        except Exception:
+            self.handleError(record)
+
 #---------------------------------------------------------------------------------------------------
 
 class SortedQueue(object):
     """
     an object representing a sorted Queue
-    items are sorted by their expiration times (when they timeout)
+    items are sorted by their priority (smaller values are more urgent) and then by their expiration times (when they timeout)
+    items with the same priority form a "lane" and nextExpired returns the first expired item from the most urgent lane,
+    so an urgent item never waits behind bulk work that has fallen behind but also never blocks less urgent items that are due while it is not
+
+    priorities can be overridden by item name via the priorities dictionary
 
     WARNING: we may want to replace this with the SortedContainers module's SortedList(WithKey?) 
         almost certainly has faster insertion than what you've written and comes with many convenient features already implemented
     """
 
-    def __init__(self):
+    def __init__(self, priorities=None):
         self.__queue__ = []
+        self.__keys__ = [] ### (priority, expiration) for each item in __queue__, used for binary searches
         self.complete = 0
+        self.counts = {} ### the number of items in the queue with each name. Maintained as items are added and removed
+        self.lanes = {} ### the number of items in the queue with each priority. Maintained as items are added and removed
+        self.priorities = priorities if priorities is not None else {} ### name -> priority, overrides item.priority
+
+    def __getstate__(self):
+        """
+        checkpoints store the expirations within our keys on the wall clock so they can be loaded by other processes (see monotonic)
+        """
+        state = self.__dict__.copy()
+        if state.has_key('__keys__'):
+            step = clockStep()
+            state['__keys__'] = [(priority, expiration+step) for priority, expiration in state['__keys__']]
+        return state
+
+    def __setstate__(self, state):
+        """
+        support for unpickling queues that were checkpointed before we cached counts and priorities
+        NOTE: items may not be fully unpickled yet (they can refer back to this queue), so we only touch them if we have to
+        """
+        self.__dict__.update(state)
+        if not hasattr(self, 'priorities'):
+            self.priorities = {}
+        if hasattr(self, '__keys__'):
+            step = clockStep()
+            self.__keys__ = [(priority, expiration-step) for priority, expiration in self.__keys__]
+        else:
+            self.resort()
+        if not (hasattr(self, 'counts') and hasattr(self, 'lanes')):
+            self.setCounts()
 
     def __str__(self):
         return "SortedQueue{queue=[%s]}"%(", ".join(str(item) for item in self.__queue__))
@@ -75,6 +570,12 @@ class SortedQueue(object):
     def __getitem__(self, ind):
         return self.__queue__[ind]
 
+    def key(self, item):
+        """
+        the key by which item is sorted
+        """
+        return (self.priorities.get(item.name, item.priority), item.expiration)
+
     def insert(self, newItem):
         """
         insert a newItem into the queue
@@ -82,28 +583,95 @@ class SortedQueue(object):
         always inserts newItem in the correct location to 
         preserve the queue's order
 
-        WARNING: insertion is achieved via a direct iteration over the queue. 
-        We may be able to speed this up with a clever data structure (besides a linked list)
+        newItem is placed after all items with the same key, so items with identical keys are executed in the order they were inserted
         """
         if not isinstance(newItem, QueueItem):
             raise ValueError("SortedQueue *must* contain only QueueItems")
 
-        for ind, item in enumerate(self.__queue__): ### iterate through queue and insert where appropriate
-            if item.expiration > newItem.expiration:
-                self.__queue__.insert( ind, newItem )
-                break
-        else:
-            self.__queue__.append( newItem )
+        key = self.key(newItem)
+        ind = bisect.bisect_right(self.__keys__, key)
+        self.__keys__.insert( ind, key )
+        self.__queue__.insert( ind, newItem )
+
         self.complete += newItem.complete
+        self.counts[newItem.name] = self.counts.get(newItem.name, 0) + 1
+        self.lanes[key[0]] = self.lanes.get(key[0], 0) + 1
 
     def pop(self, ind=0):
         """
         removes and returns the item stored at ind in the queue
         """
         item = self.__queue__.pop(ind)
+        key = self.__keys__.pop(ind)
         self.complete -= item.complete
+        self.uncount( item, key )
         return item
 
+    def find(self, item, key=None):
+        """
+        returns the index of item in the queue. We look for this specific object, not just something that compares equal to it
+        key is the key under which item was inserted (self.key(item) by default). If it is correct, this only requires a binary search.
+        Otherwise, we fall back to scanning the entire queue
+        raises a ValueError if item is not in the queue
+        """
+        if key is None:
+            key = self.key(item)
+        ind = bisect.bisect_left(self.__keys__, key)
+        while (ind < len(self.__keys__)) and (self.__keys__[ind]==key):
+            if self.__queue__[ind] is item:
+                return ind
+            ind += 1
+
+        for ind, other in enumerate(self.__queue__): ### key was stale, so we have to look everywhere
+            if other is item:
+                return ind
+        raise ValueError('item is not in this SortedQueue')
+
+    def remove(self, item, key=None):
+        """
+        removes item from the queue. See find for the meaning of key
+        raises a ValueError if item is not in the queue
+        """
+        return self.pop(self.find(item, key=key))
+
+    def reschedule(self, item, key):
+        """
+        moves item to match its current expiration (and priority), where key is the key under which it was inserted
+        we locate item with a binary search and its new position with another one over the items on the side it moves towards.
+        Only the items in between are shifted, so this is cheaper than remove followed by insert
+        as with insert, item is placed after all items with the same key
+        """
+        ind = self.find(item, key=key)
+        old = self.__keys__[ind]
+        new = self.key(item)
+        if new >= old: ### moving towards the back
+            dest = bisect.bisect_right(self.__keys__, new, ind+1) - 1
+            self.__keys__[ind:dest] = self.__keys__[ind+1:dest+1]
+            self.__queue__[ind:dest] = self.__queue__[ind+1:dest+1]
+        else: ### moving towards the front
+            dest = bisect.bisect_right(self.__keys__, new, 0, ind)
+            self.__keys__[dest+1:ind+1] = self.__keys__[dest:ind]
+            self.__queue__[dest+1:ind+1] = self.__queue__[dest:ind]
+        self.__keys__[dest] = new
+        self.__queue__[dest] = item
+
+        if new[0]!=old[0]: ### item changed lanes
+            self.lanes[old[0]] -= 1
+            if not self.lanes[old[0]]:
+                self.lanes.pop(old[0])
+            self.lanes[new[0]] = self.lanes.get(new[0], 0) + 1
+
+    def uncount(self, item, key):
+        """
+        decrement the count of items with item.name and with priority=key[0]
+        """
+        self.counts[item.name] -= 1
+        if not self.counts[item.name]:
+            self.counts.pop(item.name)
+        self.lanes[key[0]] -= 1
+        if not self.lanes[key[0]]:
+            self.lanes.pop(key[0])
+
     def clean(self):
         """
         remove all completed items from the queue
@@ -111,15 +679,104 @@ class SortedQueue(object):
         remove = [ind for ind, item in enumerate(self.__queue__) if item.complete] ### identify the items that are complete
         remove.reverse() ### start from the back so we don't mess up any indecies
         for ind in remove:
-            self.__queue__.pop(ind) ### remove this item
+            self.uncount( self.__queue__.pop(ind), self.__keys__.pop(ind) ) ### remove this item
         self.complete = 0
 
+    def countExpired(self, t):
+        """
+        returns the number of items with expiration <= t
+        relies on each lane being sorted, so this only requires a binary search per lane
+        """
+        n = 0
+        for priority in self.lanes.keys():
+            n += bisect.bisect_right(self.__keys__, (priority, t)) - bisect.bisect_left(self.__keys__, (priority, -infty))
+        return n
+
+    def nextExpired(self, t):
+        """
+        returns the index of the first item from the most urgent lane that has expired by t (expiration < t)
+        returns None if nothing has expired
+        """
+        for priority in sorted(self.lanes.keys()):
+            ind = bisect.bisect_left(self.__keys__, (priority, -infty)) ### the first item in this lane
+            if self.__queue__[ind].expiration < t:
+                return ind
+        return None
+
+    def laneExpired(self, priority, t):
+        """
+        returns the indices of the items with this priority that have expired by t (expiration < t), in order of expiration
+        """
+        return xrange(bisect.bisect_left(self.__keys__, (priority, -infty)), bisect.bisect_left(self.__keys__, (priority, t)))
+
+    def nextExpiration(self):
+        """
+        returns the earliest expiration among the first items in each lane (infty if the queue is empty)
+        nothing needs attention before this time unless something new is inserted
+        """
+        t = infty
+        for priority in self.lanes.keys():
+            t = min(t, self.__keys__[bisect.bisect_left(self.__keys__, (priority, -infty))][1])
+        return t
+
     def resort(self):
         """
         sorts all items in case there's been modifications
         Hopefully, this won't be needed but we provide it just in case
         """
-        self.__queue__.sort(key=lambda item: item.expiration)
+        self.__queue__.sort(key=self.key)
+        self.__keys__ = [self.key(item) for item in self.__queue__]
+
+    def merge(self, items, replace=False):
+        """
+        adds items (eg: another SortedQueue) to the queue all at once
+        if replace, we first discard everything already in the queue. Either way, we keep the same SortedQueue object
+
+        this is linear in the size of both queues when items are already sorted (as they are in a SortedQueue with the same priorities)
+        because sort recognizes and merges the two sorted runs. Items with identical keys keep their order, with existing items first
+        if items is a SortedQueue with the same priorities, we reuse its keys and counts. If we are (or become) empty, we simply copy its lists
+        """
+        counted = isinstance(items, SortedQueue) and (items.priorities==self.priorities) ### already sorted and counted under our keys
+        if counted and (replace or (not self.__queue__)):
+            self.__queue__ = list(items.__queue__)
+            self.__keys__ = list(items.__keys__)
+            self.complete = items.complete
+            self.counts = dict(items.counts)
+            self.lanes = dict(items.lanes)
+            return
+
+        if counted:
+            new = zip(items.__keys__, items.__queue__)
+        else:
+            new = []
+            for item in items:
+                if not isinstance(item, QueueItem):
+                    raise ValueError("SortedQueue *must* contain only QueueItems")
+                new.append( (self.key(item), item) )
+
+        if replace:
+            self.__queue__ = []
+            self.__keys__ = []
+            self.complete = 0
+            self.counts = {}
+            self.lanes = {}
+
+        if counted:
+            self.complete += items.complete
+            for name, n in items.counts.items():
+                self.counts[name] = self.counts.get(name, 0) + n
+            for priority, n in items.lanes.items():
+                self.lanes[priority] = self.lanes.get(priority, 0) + n
+        else:
+            for key, item in new:
+                self.complete += item.complete
+                self.counts[item.name] = self.counts.get(item.name, 0) + 1
+                self.lanes[key[0]] = self.lanes.get(key[0], 0) + 1
+
+        pairs = zip(self.__keys__, self.__queue__) + new
+        pairs.sort(key=operator.itemgetter(0)) ### stable, and linear for two sorted runs
+        self.__keys__ = [key for key, item in pairs]
+        self.__queue__ = [item for key, item in pairs]
 
     def setComplete(self):
         """
@@ -128,7 +785,543 @@ class SortedQueue(object):
         this should NOT be necessary as long as queue is properly managed externally
         """
         self.complete = sum([item.complete for item in self.__queue__])
+
+    def setCounts(self):
+        """
+        iterates over self.queue to determine the number of items with each name and priority
+
+        this should NOT be necessary as long as queue is properly managed externally
+        """
+        self.counts = {}
+        self.lanes = {}
+        for item, key in zip(self.__queue__, self.__keys__):
+            self.counts[item.name] = self.counts.get(item.name, 0) + 1
+            self.lanes[key[0]] = self.lanes.get(key[0], 0) + 1
         
+class DedupCache(object):
+    """
+    a bounded cache of payload digests used to drop exact duplicates (eg: from network retries)
+    digests are forgotten once they are older than ttl seconds or once the cache holds more than maxSize digests,
+    in which case the least recently seen digests are forgotten first
+    """
+
+    def __init__(self, maxSize=1000, ttl=600):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.__cache__ = OrderedDict() ### digest -> the last time we saw it. Ordered from least to most recently seen
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.__cache__)
+
+    def digest(self, payload):
+        """
+        returns the digest of payload (a string)
+        """
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+        return hashlib.sha1(payload).digest()
+
+    def seen(self, payload, now=None):
+        """
+        returns True if we have seen payload within the last ttl seconds, otherwise returns False
+        either way, payload is recorded as the most recently seen
+        """
+        if now is None:
+            now = monotonic()
+
+        ### forget digests that are too old
+        while self.__cache__:
+            key, t = next(self.__cache__.iteritems()) ### the least recently seen digest
+            if t >= now-self.ttl:
+                break
+            self.__cache__.pop(key)
+
+        key = self.digest(payload)
+        if self.__cache__.has_key(key):
+            self.hits += 1
+            self.__cache__.pop(key) ### re-inserted below so it becomes the most recently seen
+            ans = True
+        else:
+            self.misses += 1
+            ans = False
+        self.__cache__[key] = now
+
+        ### forget the least recently seen digests if we are too big
+        while len(self.__cache__) > self.maxSize:
+            self.__cache__.popitem(last=False)
+
+        return ans
+
+class TokenBuckets(object):
+    """
+    a token bucket for each key (eg: GraceID), used to limit how often we execute QueueItems for any one key
+    each bucket holds at most burst tokens and refills at rate tokens per second. Buckets start full
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self.rate = rate
+        self.burst = burst if burst else max(1.0, rate) ### by default, allow one second's worth of tokens at once
+        self.__buckets__ = {} ### key -> (tokens, time of last update)
+
+    def __len__(self):
+        return len(self.__buckets__)
+
+    def tokens(self, key, now):
+        """
+        returns the number of tokens available for key at now
+        """
+        if not self.__buckets__.has_key(key):
+            return self.burst
+        tokens, t = self.__buckets__[key]
+        return min(self.burst, tokens + (now-t)*self.rate)
+
+    def allowed(self, key, now):
+        """
+        returns True if key has a token available at now
+        """
+        return self.tokens(key, now) >= 1
+
+    def take(self, key, now):
+        """
+        removes a token from key's bucket if one is available
+        returns True if we took a token and False otherwise
+        """
+        tokens = self.tokens(key, now)
+        if tokens < 1:
+            return False
+        self.__buckets__[key] = (tokens-1, now)
+        return True
+
+    def prune(self, now):
+        """
+        forgets buckets that have refilled completely, which behave exactly like buckets we have never seen
+        """
+        for key in self.__buckets__.keys():
+            if self.tokens(key, now) >= self.burst:
+                self.__buckets__.pop(key)
+
+def nextFair(queue, queueByGraceID, t, lastServed, buckets=None, limit=100):
+    """
+    returns the index of the expired item (expiration < t) that should be executed next, or None if nothing may be executed
+    we consider the most urgent lane that has an expired item we are allowed to execute and choose the item whose GraceID was served least recently
+    (lastServed : graceid -> a counter recording when we last executed an item for that graceid), so GraceIDs take turns when we fall behind
+    items whose GraceID has no tokens left in buckets are skipped. Items that are not tracked in queueByGraceID (eg: without a graceid attribute)
+    are never limited and always go first
+
+    candidates are the first expired item for each GraceID, found through queueByGraceID, so a quiet GraceID is served no matter how many
+    expired items a noisy one has. Untracked items are found by scanning queue, where only the first limit expired items in each lane are considered
+    """
+    best = None ### (priority, served, expiration, item)
+    for graceid, byGraceID in queueByGraceID.items():
+        if (buckets is not None) and (not buckets.allowed(graceid, t)):
+            continue
+        served = lastServed.get(graceid, -1)
+        for priority in byGraceID.lanes.keys(): ### byGraceID may not share queue's priorities, so we check the head of each of its lanes
+            for ind in byGraceID.laneExpired(priority, t):
+                item = byGraceID[ind]
+                if not item.complete:
+                    key = queue.key(item)
+                    if (best is None) or ((key[0], served, key[1]) < best[:3]):
+                        best = (key[0], served, key[1], item)
+                    break
+
+    for priority in sorted(queue.lanes.keys()):
+        if (best is not None) and (priority > best[0]):
+            break
+        for ind in itertools.islice(queue.laneExpired(priority, t), limit):
+            item = queue[ind]
+            if (not item.complete) and (not queueByGraceID.has_key(getattr(item, 'graceid', None))):
+                return ind
+
+    if best is None:
+        return None
+    return queue.find(best[3], key=(best[0], best[2]))
+
+def markComplete(queue, queueByGraceID, item):
+    """
+    marks item as complete so it is ignored (and eventually removed) within queue and removes it from queueByGraceID
+    """
+    item.complete = True
+    queue.complete += 1
+    if hasattr(item, 'graceid') and queueByGraceID.has_key(item.graceid):
+        try:
+            queueByGraceID[item.graceid].remove( item )
+        except ValueError: ### already removed
+            pass
+        if not len(queueByGraceID[item.graceid]):
+            queueByGraceID.pop(item.graceid)
+
+def deadLetter(item, error):
+    """
+    returns a record of an item that failed (error is usually a traceback), for interactiveQueue's dead letters
+    this only contains basic types so it can be passed around as json (see commands.DeadLettersTask)
+    """
+    return {
+        'time'        : time.time(),
+        'name'        : item.name,
+        'description' : item.description,
+        'graceid'     : getattr(item, 'graceid', None),
+        'tasks'       : [task.name for task in item.tasks], ### the tasks that were never completed, starting with the one that failed
+        'failures'    : sum(getattr(task, 'failures', 0) for task in item.tasks),
+        'error'       : error,
+    }
+
+def itemRecord(item, step=None):
+    """
+    returns a summary of item that only contains basic types so it can be written as json (see exportItems)
+    times are on the wall clock (see mono2wall). step is the clockStep used for the conversion, which is read if not supplied
+    infinite times (eg: the expiration of an item with no tasks) are reported as None
+    """
+    if step is None:
+        step = clockStep()
+    wall = lambda t: t+step if (t is not None) and (abs(t)!=infty) else None
+    return {
+        'name'       : item.name,
+        'graceid'    : getattr(item, 'graceid', None),
+        'priority'   : item.priority,
+        'complete'   : item.complete,
+        't0'         : wall(item.t0),
+        'expiration' : wall(item.expiration),
+        'tasks'      : [task.name for task in item.tasks], ### pending tasks, in the order they will be executed
+    }
+
+def exportItems(items, file_obj):
+    """
+    writes one json object (see itemRecord) per line into file_obj for each of items
+    records are written as we go, so we never hold more than one line in memory
+
+    returns the number of items written
+    """
+    step = clockStep() ### read once so every record agrees
+    n = 0
+    for item in items:
+        file_obj.write( json.dumps(itemRecord(item, step=step))+"\n" )
+        n += 1
+    return n
+
+#------------------------
+
+__checkpointFormat__ = ('lvalertMP checkpoint', 1) ### written first by dumpQueue. Older checkpoints start with a pickled SortedQueue instead
+
+class __Link__(object):
+    """
+    stands in for a reference to the queue or queueByGraceID being checkpointed (see dumpQueue)
+    """
+    def __init__(self, name):
+        self.name = name
+
+class __Empty__(object):
+    """
+    stands in for a separate, empty container of type cls for each object in a group (eg: Task.kwargs). See __packStates__
+    """
+    def __init__(self, cls):
+        self.cls = cls
+
+def __packStates__(objs, links, special=()):
+    """
+    packs the attributes (__dict__) of each of objs into columns, grouping objects by class and by the names of their attributes
+
+    an attribute that is the same object for every member of a group is stored once (and not at all if it is just the class attribute)
+    as is one that is a separate empty dict or list for every member. References to the objects in links (id -> name) are replaced by __Link__s.
+    We never look inside any other values. The attributes named in special are not stored (see __unpackStates__)
+
+    returns a list of groups (cls, positions, constants, columns, linked), where positions are the indices of the members within objs (None if that is all of them, in order),
+    constants and columns map names to a value and a list of values (one per member), respectively, and linked lists the columns that contain __Link__s
+    """
+    classes = map(type, objs)
+    if classes.count(classes[0])==len(classes): ### the usual case, so we avoid grouping in python
+        byClass = [(classes[0], None)]
+    else:
+        byClass = {}
+        for ind, cls in enumerate(classes):
+            byClass.setdefault(cls, []).append(ind)
+        byClass = byClass.items()
+
+    groups = []
+    for cls, positions in byClass:
+        states = map(vars, objs if positions is None else map(objs.__getitem__, positions))
+        names = states[0].keys()
+        try:
+            if set(map(len, states))!=set([len(names)]):
+                raise KeyError
+            byNames = [(names, positions, [map(operator.itemgetter(name), states) for name in names])] ### raises KeyError unless every member has these names
+        except KeyError: ### members have different attributes (eg: they were created by an older version), so we group them by name
+            byNames = {}
+            for ind, state in enumerate(states):
+                byNames.setdefault(tuple(sorted(state.keys())), []).append(ind)
+            byNames = [(names, [ind if positions is None else positions[ind] for ind in inds], [[states[ind][name] for ind in inds] for name in names]) \
+                for names, inds in byNames.items()]
+
+        for names, positions, values in byNames:
+            constants = {}
+            columns = {}
+            linked = []
+            for name, column in itertools.izip(names, values):
+                if name in special:
+                    columns[name] = None
+                    continue
+                first = column[0]
+                if len(column)==1:
+                    pass
+                elif all(itertools.imap(operator.is_, column, itertools.repeat(first))): ### the same object, not just equal ones
+                    if not (hasattr(cls, name) and (getattr(cls, name) is first)): ### otherwise the class attribute already provides it
+                        constants[name] = __Link__(links[id(first)]) if links.has_key(id(first)) else first
+                    continue
+                elif (type(first) in (dict, list)) and (not any(column)) and all(itertools.imap(operator.is_, itertools.imap(type, column), itertools.repeat(type(first)))) \
+                  and (len(set(itertools.imap(id, column)))==len(column)): ### separate empty containers
+                    constants[name] = __Empty__(type(first))
+                    continue
+                if any(itertools.imap(links.has_key, itertools.imap(id, column))):
+                    column = [__Link__(links[id(value)]) if links.has_key(id(value)) else value for value in column]
+                    linked.append( name )
+                columns[name] = column
+            groups.append( (cls, positions, constants, columns, linked) )
+
+    return groups
+
+def __unpackStates__(groups, n, links, delta=0, special={}):
+    """
+    the inverse of __packStates__, returning a list of n objects without calling __init__ or __setstate__
+    links maps the names of __Link__s to the objects they refer to and delta is added to every time (t0 and expiration)
+    special maps the attribute names that were not stored to lists of their values (one per object)
+    """
+    objs = [None]*n
+    for cls, positions, constants, columns, linked in groups:
+        m = n if positions is None else len(positions)
+        for name in linked:
+            columns[name] = [links[value.name] if isinstance(value, __Link__) else value for value in columns[name]]
+        for name, value in constants.items():
+            if isinstance(value, __Link__):
+                constants[name] = links[value.name]
+            elif isinstance(value, __Empty__):
+                columns[name] = [value.cls() for _ in xrange(m)]
+                constants.pop(name)
+        for name, values in special.items():
+            if columns.has_key(name):
+                columns[name] = values if positions is None else map(values.__getitem__, positions)
+        if delta:
+            for name in ['t0', 'expiration']:
+                if columns.has_key(name):
+                    columns[name] = [t+delta if t is not None else None for t in columns[name]]
+                elif constants.get(name, None) is not None:
+                    constants[name] += delta
+
+        names = constants.keys() + columns.keys()
+        values = [itertools.repeat(value, m) for value in constants.values()] + columns.values()
+        states = map(dict, itertools.imap(itertools.izip, itertools.repeat(names, m), itertools.izip(*values))) if names else [{} for _ in xrange(m)]
+        members = map(cls.__new__, itertools.repeat(cls, m))
+        map(setattr, members, itertools.repeat('__dict__', m), states)
+        if positions is None:
+            objs = members
+        else:
+            map(objs.__setitem__, positions, members)
+    return objs
+
+def dumpQueue(queue, queueByGraceID, file_obj):
+    """
+    writes queue and queueByGraceID into file_obj so that loadQueue can recreate them quickly, eg: in another process
+
+    rather than pickling every QueueItem and Task (and converting their times one at a time), we pickle their attributes in columns (see __packStates__).
+    Times are stored on the clock used for expirations (see monotonic) along with a single clockStep, so loadQueue converts them all at once.
+    Items are written once even if they appear in both queue and queueByGraceID, and references to queue and queueByGraceID
+    (eg: from commands) are recorded so that loadQueue can point them at the queues it loads into
+
+    returns the number of items written
+    """
+    import cPickle as pickle
+
+    with FixedClockStep():
+        items = list(queue) ### every item, starting with the ones in queue
+        index = dict(itertools.izip(itertools.imap(id, items), itertools.count()))
+        for q in queueByGraceID.values():
+            for item in q:
+                if not index.has_key(id(item)):
+                    index[id(item)] = len(items)
+                    items.append( item )
+
+        ### tasks are written once in a single list. The tasks of items[i] are tasks[bounds[2*i]:bounds[2*i+1]], followed by its completedTasks
+        tasks = []
+        bounds = [0]
+        for item in items:
+            tasks += item.tasks
+            bounds.append( len(tasks) )
+            tasks += item.completedTasks
+            bounds.append( len(tasks) )
+
+        links = {id(queue):'queue', id(queueByGraceID):'queueByGraceID'}
+        pack = lambda q: (type(q), dict((key, value) for key, value in vars(q).items() if key not in ['__queue__', '__keys__']), \
+            map(index.__getitem__, itertools.imap(id, q)), map(operator.itemgetter(0), q.__keys__), map(operator.itemgetter(1), q.__keys__))
+
+        pickler = pickle.Pickler( file_obj, pickle.HIGHEST_PROTOCOL ) ### a single Pickler so shared attributes (eg: alerts) are only written once
+        pickler.dump( __checkpointFormat__ )
+        pickler.dump( {
+            'clockStep'      : clockStep(),
+            'items'          : (len(items), __packStates__(items, links, special=['tasks', 'completedTasks']) if items else []),
+            'tasks'          : (len(tasks), __packStates__(tasks, links) if tasks else []),
+            'bounds'         : bounds,
+            'queue'          : pack(queue),
+            'queueByGraceID' : dict((graceid, pack(q)) for graceid, q in queueByGraceID.items()),
+        } )
+
+    return len(items)
+
+def loadQueue(queue, queueByGraceID, file_obj):
+    """
+    reads a checkpoint written by dumpQueue (or a pickled queue and queueByGraceID, as written by older versions) from file_obj
+    references to the checkpointed queue and queueByGraceID are pointed at queue and queueByGraceID instead,
+    but neither is modified (see commands.LoadQueueTask, which merges what we load into them)
+
+    returns the SortedQueue and queueByGraceID that were loaded
+    """
+    import cPickle as pickle
+
+    unpickler = pickle.Unpickler( file_obj )
+    data = unpickler.load()
+    if data!=__checkpointFormat__: ### an older checkpoint, which pickled the queues directly
+        with FixedClockStep():
+            loaded = data
+            loadedByGraceID = unpickler.load()
+        for item in loaded:
+            for task in item.tasks:
+                if getattr(task, 'queue', None) is loaded:
+                    task.queue = queue
+                    task.queueByGraceID = queueByGraceID
+        return loaded, loadedByGraceID
+
+    data = unpickler.load()
+    delta = data['clockStep'] - clockStep() ### how far the wall clock has moved relative to our monotonic clock since we checkpointed
+    links = {'queue':queue, 'queueByGraceID':queueByGraceID}
+
+    n, groups = data['tasks']
+    tasks = __unpackStates__(groups, n, links, delta=delta)
+    bounds = data['bounds']
+    n, groups = data['items']
+    items = __unpackStates__(groups, n, links, delta=delta, special={
+        'tasks'          : map(tasks.__getslice__, bounds[0:-1:2], bounds[1::2]),
+        'completedTasks' : map(tasks.__getslice__, bounds[1::2], bounds[2::2]),
+    })
+
+    def unpack(packed):
+        cls, state, inds, priorities, expirations = packed
+        q = cls.__new__(cls)
+        q.__dict__.update(state)
+        q.__queue__ = map(items.__getitem__, inds)
+        q.__keys__ = zip(priorities, [t+delta for t in expirations] if delta else expirations)
+        return q
+
+    return unpack(data['queue']), dict((graceid, unpack(q)) for graceid, q in data['queueByGraceID'].items())
+
+def shed(queue, queueByGraceID, n, priority=1):
+    """
+    marks up to n items with priority >= priority as complete, starting with the least urgent lane and the latest expirations within each lane
+    more urgent items (eg: commands) are never shed
+
+    returns the number of items that were shed
+    """
+    N = 0
+    for ind in xrange(len(queue)-1, -1, -1): ### queue is sorted by (priority, expiration), so we iterate backwards
+        if N >= n:
+            break
+        item = queue[ind]
+        if queue.key(item)[0] < priority: ### everything from here on is more urgent
+            break
+        if not item.complete:
+            markComplete(queue, queueByGraceID, item)
+            N += 1
+    return N
+
+def collapse(queue, queueByGraceID, priority=1):
+    """
+    marks all but the most recent item (largest t0) with priority >= priority as complete for each GraceID
+    more urgent items (eg: commands) are never collapsed
+
+    returns the number of items that were marked complete
+    """
+    N = 0
+    for graceid, q in queueByGraceID.items():
+        items = [item for item in q if (not item.complete) and (queue.key(item)[0] >= priority)] ### queue knows about priority overrides, q does not
+        if len(items) > 1:
+            latest = max(items, key=lambda item: item.t0)
+            for item in items:
+                if item is not latest:
+                    markComplete(queue, queueByGraceID, item)
+                    N += 1
+    return N
+
+def coalesce(queueByGraceID, alert, t0, window):
+    """
+    look for a QueueItem associated with alert's uid that was generated by an alert with the same alert_type within window seconds of t0
+    if we find one that can absorb alert, we merge alert into it.
+
+    returns the item into which alert was merged or None if there was no suitable item
+    """
+    graceid = alert['uid']
+    if not queueByGraceID.has_key(graceid):
+        return None
+    alert_type = alert.get('alert_type', None)
+    for item in queueByGraceID[graceid]:
+        if (item.alert_type==alert_type) and (abs(t0-item.t0) <= window) and item.canCoalesce(alert, t0):
+            item.coalesce(alert, t0)
+            return item
+    return None
+
+#---------------------------------------------------------------------------------------------------
+
+### parameters of interactiveQueue that can be changed while it is running
+### listed in the order in which interactiveQueue accepts them
+paramNames = ['sleep', 'maxComplete', 'maxFrac', 'warnThr', 'recipients', 'warnDelay', 'maxWarn']
+
+def checkParam(name, value):
+    """
+    casts value to the type expected for the interactiveQueue parameter called name and makes sure it is sensible
+    recipients may be a list or a string of whitespace-separated addresses
+
+    raises ValueError if name is not known or value is not allowed
+    returns the cast value
+    """
+    if name not in paramNames:
+        raise ValueError('%s is not a known parameter. Known parameters are : %s'%(name, ", ".join(paramNames)))
+
+    if name=='recipients':
+        if isinstance(value, basestring):
+            return value.split()
+        if not (isinstance(value, (list, tuple)) and all(isinstance(recipient, basestring) for recipient in value)):
+            raise ValueError('recipients must be a list of strings')
+        return list(value)
+
+    try:
+        if name in ['maxComplete', 'maxWarn']:
+            cast = int(float(value))
+            if cast!=float(value):
+                raise ValueError('%s must be an integer'%name)
+        else:
+            cast = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('could not interpret %s=%s'%(name, value))
+
+    if cast < 0:
+        raise ValueError('%s must be non-negative'%name)
+    if (name=='maxFrac') and (cast > 1):
+        raise ValueError('maxFrac must be <= 1')
+
+    return cast
+
+def updateParams(params, new):
+    """
+    validates everything in new (see checkParam) and then updates params
+    nothing is changed if any value in new is not allowed
+
+    returns a dictionary of the parameters that changed : name -> (old, new)
+    """
+    new = dict((name, checkParam(name, value)) for name, value in new.items()) ### raises ValueError before we change anything
+    changes = dict((name, (params.get(name, None), value)) for name, value in new.items() if params.get(name, None)!=value)
+    params.update( new )
+    return changes
+
 #-------------------------------------------------
 
 class Task(object):
@@ -142,6 +1335,12 @@ class Task(object):
     """
     name = "task"
     description = "a task"
+    priority = 1 ### smaller values are more urgent. QueueItems take the most urgent priority of their tasks
+
+    deadline = None ### the longest (sec) a single call to execute may run. None means no limit
+    retries = 0 ### the number of times we try again after execute raises or runs past deadline
+    backoff = 1.0 ### we wait backoff*2**(n-1) sec before the n-th retry
+    retryJitter = 0 ### plus a random amount up to retryJitter sec, so failures that happen together are not retried together
 
     def __init__(self, timeout, logTag='iQ', **kwargs ):
 
@@ -152,22 +1351,51 @@ class Task(object):
 
         self.logTag = logTag ### used to set up logger
 
+        self.result = None ### the value returned by the most recent call to execute
+
+        self.token = None ### the CancelToken for the current call to execute
+        self.timeouts = 0 ### the number of times execute ran past deadline
+        self.failures = 0 ### the number of consecutive times execute failed (including timeouts). Reset once it succeeds
+        self.retrying = False ### whether the most recent call to execute failed and we are waiting to try again
+
     def __str__(self):
         return "Task{%s : %s, expiration=%s}"%(self.name, self.description, '%.3f'%self.expiration if self.expiration!=None else 'None')
 
+    def __getstate__(self):
+        """
+        checkpoints store expirations on the wall clock so they can be loaded by other processes (see monotonic)
+        """
+        state = self.__dict__.copy()
+        if state.get('expiration', None) is not None:
+            state['expiration'] = mono2wall(state['expiration'])
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if getattr(self, 'expiration', None) is not None:
+            self.expiration = wall2mono(self.expiration)
+
     def setExpiration(self, t0):
         """
         set expiration relative to start time provided (t0)
+        t0 should come from the clock used for expirations (see monotonic)
         """
         self.expiration = t0+self.timeout
 
+    def getLogger(self):
+        """
+        returns the (cached) logger named "logTag.name", which propagates to interactiveQueue's logger
+        we do not store this as an attribute so that Tasks can still be pickled
+        """
+        return getLogger(self.logTag, self.name)
+
     def hasExpired(self):
         """
         check whether this task has timed out
         """
         if self.expiration==None:
             raise ValueError("must call setExpiration before calling hasExpired!")
-        return time.time() > self.expiration
+        return monotonic() > self.expiration
 
     def execute(self, verbose=False):
         """
@@ -179,8 +1407,49 @@ class Task(object):
         as an example. A specific example is within eventSupervisor, where emails
         are sent depending on the result of the delegation. Nonetheless, this could be accomplished
         by simply overwriting .execute for each subclass as needed.
+
+        if deadline is set, the delegation is interrupted once it runs that long. It can also check self.token (a CancelToken) to stop cleanly.
+        If the delegation fails (raises or runs past deadline), we try again after retryDelay (by pushing back our expiration)
+        until it has failed retries times in a row, after which we raise the exception
+        While a retry is pending, self.retrying is True so QueueItem.execute keeps us even if retryDelay is 0
         """
-        return getattr(self, self.name)( verbose=verbose, **self.kwargs )
+        self.token = CancelToken(self.deadline)
+        try:
+            self.result = callWithDeadline( self.deadline, getattr(self, self.name), verbose=verbose, **self.kwargs )
+        except (Exception, DeadlineExceeded) as e:
+            if isinstance(e, DeadlineExceeded):
+                if not self.token.expired(): ### an enclosing deadline, not ours
+                    raise
+                self.timeouts = getattr(self, 'timeouts', 0) + 1 ### getattr supports Tasks loaded from old checkpoints
+                reason = 'ran past its deadline of %.3f sec'%self.deadline
+            else:
+                reason = 'raised %s'%repr(e)
+            self.failures = getattr(self, 'failures', 0) + 1
+            self.result = None
+            self.retrying = False
+            if self.failures > self.retries:
+                if self.retries:
+                    self.getLogger().warn( '%s %s; giving up after %d attempts', self.name, reason, self.failures )
+                raise
+            delay = self.retryDelay()
+            self.getLogger().warn( '%s %s; retrying in %.3f sec (retry %d of %d)', self.name, reason, delay, self.failures, self.retries )
+            self.expiration = monotonic() + delay ### QueueItem.execute will reschedule us
+            self.retrying = True
+        else:
+            self.failures = 0 ### retries only counts consecutive failures
+            self.retrying = False
+        finally:
+            self.token = None
+        return self.result
+
+    def retryDelay(self):
+        """
+        how long (sec) we wait before retrying after our most recent failure
+        """
+        delay = self.backoff*2**(self.failures-1)
+        if self.retryJitter:
+            delay += random.uniform(0, self.retryJitter)
+        return delay
 
     def task(self, verbose=False, **kwargs):
         """
@@ -188,6 +1457,83 @@ class Task(object):
         """
         pass
 
+    def canCoalesce(self, alert):
+        """
+        whether this task can absorb alert instead of having a new QueueItem scheduled for it
+        by default tasks cannot be coalesced. Children that support this should also overwrite coalesce
+        """
+        return False
+
+    def coalesce(self, alert, t0):
+        """
+        absorb alert into this task. Only called if canCoalesce returned True, so this does nothing by default
+        children that return True from canCoalesce should overwrite this
+        """
+        pass
+
+class PeriodicTask(Task):
+    """
+    a task that repeats every interval seconds
+    each run is delayed by a random amount between 0 and jitter seconds so that many PeriodicTasks started together do not all run at once.
+    Jitter does not accumulate; runs stay on the schedule set by interval. If we fall behind, we skip the runs we missed rather than executing them back-to-back.
+    The task is complete once it has run maxRuns times (never if maxRuns is None)
+
+    the first run happens timeout seconds after the reference time supplied to setExpiration (interval by default)
+    QueueItems reschedule PeriodicTasks without re-sorting (see QueueItem.reschedule) and interactiveQueue moves the QueueItem with a binary search (see SortedQueue.reschedule)
+    """
+    name = "periodic"
+    description = "a task that repeats"
+
+    def __init__(self, interval, jitter=0, maxRuns=None, timeout=None, logTag='iQ', **kwargs):
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+        if jitter < 0:
+            raise ValueError('jitter must be non-negative')
+        self.interval = interval
+        self.jitter = jitter
+        self.maxRuns = maxRuns
+        self.runs = 0 ### the number of times we have executed
+        self.offset = 0 ### the jitter applied to the current expiration
+        super(PeriodicTask, self).__init__(interval if timeout is None else timeout, logTag=logTag, **kwargs)
+
+    def setExpiration(self, t0):
+        """
+        set expiration relative to start time provided (t0), including a random jitter
+        """
+        self.offset = random.uniform(0, self.jitter) if self.jitter else 0
+        self.expiration = t0+self.timeout+self.offset
+
+    def done(self):
+        """
+        whether we have run maxRuns times
+        """
+        return (self.maxRuns is not None) and (self.runs >= self.maxRuns)
+
+    def periodic(self, verbose=False, **kwargs):
+        """
+        dummy function required for syntax of this object. Children should overwrite this (and name)
+        """
+        pass
+
+    def execute(self, verbose=False):
+        """
+        perform the associated function call and schedule the next run
+        once we are done, we leave expiration in the past so QueueItem.execute marks us as completed
+        """
+        result = super(PeriodicTask, self).execute(verbose=verbose)
+        if self.retrying: ### we failed and are retrying, so this does not count as a run
+            self.offset = 0
+            return result
+        self.runs += 1
+        if not self.done():
+            now = monotonic()
+            scheduled = self.expiration-self.offset+self.interval ### the next run without jitter
+            if scheduled <= now: ### we fell behind, so skip to the next run in the future
+                scheduled += self.interval*(1+int((now-scheduled)/self.interval))
+            self.offset = random.uniform(0, self.jitter) if self.jitter else 0
+            self.expiration = scheduled+self.offset
+        return result
+
 class QueueItem(object):
     """
     an item for the sorted Queue
@@ -196,6 +1542,8 @@ class QueueItem(object):
     """
     name = "item"
     description = "a series of connected tasks"
+    alert_type = None ### the alert_type of the alert that generated this item. Only items with matching alert_types are coalesced
+    priority = 1 ### smaller values are more urgent. See SortedQueue
 
     def __init__(self, t0, tasks, logTag='iQ'):
 
@@ -215,6 +1563,22 @@ class QueueItem(object):
     def __str__(self):
         return "QueueItem{%s : %s, expiration=%.3f, complete=%s, tasks=[%s]}"%(self.name, self.description, self.expiration, self.complete, "|".join(str(task) for task in self.tasks))
 
+    def __getstate__(self):
+        """
+        checkpoints store t0 and expiration on the wall clock so they can be loaded by other processes (see monotonic)
+        """
+        state = self.__dict__.copy()
+        for key in ['t0', 'expiration']:
+            if state.get(key, None) is not None:
+                state[key] = mono2wall(state[key])
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for key in ['t0', 'expiration']:
+            if getattr(self, key, None) is not None:
+                setattr(self, key, wall2mono(getattr(self, key)))
+
     def sortTasks(self):
         """
         sort (remaining) tasks by expiration
@@ -237,7 +1601,7 @@ class QueueItem(object):
         """
         check whether the next task has expired
         """
-        return time.time() > self.expiration
+        return monotonic() > self.expiration
 
     def execute(self, verbose=False):
         """
@@ -248,14 +1612,17 @@ class QueueItem(object):
 
             if self.hasExpired():
                 task = self.tasks.pop(0) ### extract this task
-                task.execute( verbose=verbose ) ### perform this task
-                ### NOTE: this next step could introduce a race condition, althouth it is unlikely to ever actually matter
-                ###   a more proper solution would be to give task objects "complete" attributes and to check that, but
-                ###   this should work well enough
-                if task.hasExpired(): ### check whether the task is actually done
+                try:
+                    task.execute( verbose=verbose ) ### perform this task
+                except:
+                    self.tasks.insert( 0, task ) ### task was not completed, so we keep it (eg: for deadLetter)
+                    raise
+                ### tasks waiting to retry are kept no matter their expiration (retryDelay may be 0)
+                ### otherwise, tasks that pushed their expiration into the future (eg: PeriodicTask) want to run again
+                if getattr(task, 'retrying', False) or (not task.hasExpired()): ### task is NOT done, add it back in
+                    self.reschedule( task )
+                else: ### task is done
                     self.completedTasks.append( task ) ### mark as completed
-                else: ### task is NOT done, add it back in
-                    self.add( task )
             else:
                 break
         self.complete = len(self.tasks)==0 ### only complete when there are no remaining tasks
@@ -275,10 +1642,46 @@ class QueueItem(object):
                 task.setExpiration( self.t0 )
 
             self.tasks.append( task )
+            self.priority = min(self.priority, task.priority)
 
         self.sortTasks() ### ensure tasks are sorted
         self.complete = len(self.tasks) == 0
 
+    def reschedule(self, task):
+        """
+        adds back a task that has already been added (and has set its own expiration), eg: a PeriodicTask that has just run
+        tasks are already sorted, so we only need a binary search rather than re-sorting
+        """
+        lo, hi = 0, len(self.tasks)
+        while lo < hi:
+            mid = (lo+hi)//2
+            if task.expiration < self.tasks[mid].expiration:
+                hi = mid
+            else:
+                lo = mid+1
+        self.tasks.insert( lo, task )
+        self.expiration = self.tasks[0].expiration
+        self.complete = False
+
+    def canCoalesce(self, alert, t0):
+        """
+        whether alert can be merged into this item rather than generating a new QueueItem
+        we only coalesce alerts into items that have not yet executed any tasks and only if every remaining task can absorb the alert
+        """
+        if self.complete or self.completedTasks: ### something has already been done, so merging would lose information
+            return False
+        for task in self.tasks:
+            if not task.canCoalesce(alert):
+                return False
+        return True
+
+    def coalesce(self, alert, t0):
+        """
+        merge alert into this item by delegating to each task. Only called if canCoalesce returned True
+        """
+        for task in self.tasks:
+            task.coalesce(alert, t0)
+
     def remove(self, taskName):
         """
         removes and returns the first instance of Task with a name matching taskName
@@ -5,8 +5,6 @@ author = "reed.essick@ligo.org"
 
 import lvalertMPutils as utils
 
-import logging
-
 from commands import parseCommand
 from ligo.lvalert_heartbeat.lvalertMP_heartbeat import parseHeartbeat 
 
@@ -19,6 +17,7 @@ class PrintAlertTask(utils.Task):
     def __init__(self, timeout, graceid, alert, logTag='iQ'):
         self.graceid = graceid
         self.alert = alert
+        self.numAlerts = 1 ### the number of alerts coalesced into this task
         super(PrintAlertTask, self).__init__(timeout, logTag=logTag)
 
     def printAlert(self, verbose=False):
@@ -26,8 +25,24 @@ class PrintAlertTask(utils.Task):
         an example action that we trigger off of an alert
         """
         ### set up logger
-        logger = logging.getLogger(self.logTag+'.printAlert') ### verbose means this shows up in iQ's log file
-        logger.info( "%s : %s" % (self.graceid, self.alert) )
+        logger = self.getLogger() ### verbose means this shows up in iQ's log file
+        if self.numAlerts > 1:
+            logger.info( "%s : %s (coalesced %d alerts)", self.graceid, self.alert, self.numAlerts )
+        else:
+            logger.info( "%s : %s", self.graceid, self.alert )
+
+    def canCoalesce(self, alert):
+        """
+        we only print the most recent alert, so we can absorb anything
+        """
+        return True
+
+    def coalesce(self, alert, t0):
+        """
+        keep the most recent alert
+        """
+        self.alert = alert
+        self.numAlerts += 1
 
 #-------------------------------------------------
 
@@ -44,7 +59,7 @@ def parseAlert( queue, queueByGraceID, alert, t0, config, logTag='iQ' ):
         return parseHeartbeat( queue, queueByGraceID, alert, t0, config, logTag=logTag )
 
     ### set up logger
-    logger = logging.getLogger(logTag+'.parseAlert') ### want this to propagate to interactiveQueue's logger
+    logger = utils.getLogger(logTag, 'parseAlert') ### want this to propagate to interactiveQueue's logger
 
     ### generate the tasks needed
     ### we print the alert twice to ensure the QueueItem works as expected with multiple Tasks
@@ -54,6 +69,7 @@ def parseAlert( queue, queueByGraceID, alert, t0, config, logTag='iQ' ):
     ### generate the Item which houses the tasks
     item = utils.QueueItem( t0, [taskA, taskB] )
     item.graceid = graceid 
+    item.alert_type = alert.get('alert_type', None) ### allows interactiveQueue to coalesce later alerts into this item
 
     ### add the item to the queue
     queue.insert( item )
@@ -64,7 +80,7 @@ def parseAlert( queue, queueByGraceID, alert, t0, config, logTag='iQ' ):
             queueByGraceID[graceid] = utils.SortedQueue()
         queueByGraceID[graceid].insert( item )
 
-    logger.debug( 'added QueueItem=%s'%item.name ) 
+    logger.debug( 'added QueueItem=%s', item.name ) 
 
     return 0 ### the number of new completed tasks in queue. 
              ### This is not strictly needed and is not captured and we should modify the attribute of SortedQueue directly